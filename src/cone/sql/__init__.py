@@ -3,6 +3,7 @@ from cone.app import main_hook
 from cone.app import ugm_backend
 from cone.app.ugm import UGMFactory
 from sqlalchemy import engine_from_config
+from sqlalchemy import event
 from sqlalchemy import MetaData
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session
@@ -53,6 +54,86 @@ def use_tm():
     return os.environ.get('CONE_SQL_USE_TM') == '1'
 
 
+###############################################################################
+# Change tracking
+###############################################################################
+
+# session info key of flag whether changes were written in current transaction
+changes_written_key = 'cone.sql.changes_written'
+
+# session info key of flag whether changes of session are tracked
+track_changes_key = 'cone.sql.track_changes'
+
+# session info key of flag whether commit is deferred to the end of request
+defer_commit_key = 'cone.sql.defer_commit'
+
+
+def _track_flush(session, flush_context):
+    session.info[changes_written_key] = True
+
+
+def _track_execute(orm_execute_state):
+    # bulk and textual statements executed via session
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info[changes_written_key] = True
+
+
+def _reset_changes_written(session):
+    session.info.pop(changes_written_key, None)
+
+
+@sql_session_setup
+def track_changes(session):
+    """Track changes written in the current transaction of session.
+    """
+    event.listen(session, 'after_flush', _track_flush)
+    event.listen(session, 'do_orm_execute', _track_execute)
+    event.listen(session, 'after_commit', _reset_changes_written)
+    event.listen(session, 'after_rollback', _reset_changes_written)
+    session.info[track_changes_key] = True
+
+
+def has_changes(session):
+    """Flag whether session contains pending changes or changes were written
+    in the current transaction.
+
+    Sessions not set up with ``setup_session`` are always considered
+    changed, since written changes are not tracked for them.
+    """
+    if not session.info.get(track_changes_key):
+        return True
+    if session.new or session.deleted:
+        return True
+    if session.info.get(changes_written_key):
+        return True
+    # ``session.dirty`` contains records with attributes set to their
+    # unchanged value as well
+    return any(session.is_modified(record) for record in session.dirty)
+
+
+def persist_session(session):
+    """Flush or commit session if it has changes.
+
+    Only flushes if transaction manager is used or if commit is deferred to
+    the end of the request by ``defer_commit``.
+    """
+    if not has_changes(session):
+        return
+    if use_tm() or session.info.get(defer_commit_key):
+        session.flush()
+    else:
+        session.commit()
+
+
+def defer_commit(session, defer=True):
+    """Defer commit of session to the end of the request.
+
+    Calling nodes only flushes the session then and changes of multiple
+    nodes get committed in one transaction by ``WSGISQLSession``.
+    """
+    session.info[defer_commit_key] = defer
+
+
 ###############################################################################
 # DB initialization
 ###############################################################################
@@ -81,9 +162,14 @@ class SQLSessionFactory(object):
     def __init__(self, settings, prefix):
         self.engine = engine_from_config(settings, prefix=prefix)
         self.maker = sessionmaker(bind=self.engine)
+        self.defer_commit = settings.get('sql.defer_commit') in [
+            'true', 'True', '1'
+        ]
 
     def __call__(self):
         session = self.maker()
+        if self.defer_commit:
+            defer_commit(session)
         setup_session(session)
         return session
 
@@ -101,6 +187,10 @@ class WSGISQLSession(object):
 
     Downstream applications will have the session in the environment,
     normally under the key 'cone.sql.session'.
+
+    If commit is deferred, changes are committed when the downstream
+    application starts a response with a non error status, before status
+    and body are passed to the server.
     """
 
     def __init__(self, next_app, session_key=session_key):
@@ -111,11 +201,50 @@ class WSGISQLSession(object):
         session = session_factory()
         register(session)
         environ[self.session_key] = session
+        if not session.info.get(defer_commit_key) or use_tm():
+            try:
+                return self.next_app(environ, start_response)
+            finally:
+                session.close()
+
+        def _start_response(status, headers, exc_info=None):
+            # commit before status and body are passed to the server, thus
+            # failing commits result in an error response
+            if exc_info is None and int(status.split()[0]) < 400:
+                if has_changes(session):
+                    session.commit()
+            return start_response(status, headers, exc_info)
+
         try:
-            result = self.next_app(environ, start_response)
-            return result
-        finally:
+            result = self.next_app(environ, _start_response)
+        except Exception:
             session.close()
+            raise
+        return SessionClosingResult(session, result)
+
+
+class SessionClosingResult(object):
+    """WSGI response body closing the SQL session when the server closes
+    the response.
+
+    Applications may call ``start_response`` when the body gets iterated,
+    thus the session must stay open until then. Changes made after
+    ``start_response`` was called are not committed.
+    """
+
+    def __init__(self, session, result):
+        self.session = session
+        self.result = result
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def close(self):
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            self.session.close()
 
 
 def make_app(next_app, global_conf, **local_conf):
@@ -142,6 +271,14 @@ def initialize_cone_sql(config, global_config, settings):
         # If SQL configured as UGM backend, import ugm module to ensure proper
         # table creation at initialize_sql time.
         import cone.sql.ugm  # noqa
+    # store GUID's as binary on non PostgreSQL dialects
+    if settings.get('sql.guid_binary') in ['true', 'True', '1']:
+        from cone.sql.model import GUID
+        GUID.binary = True
+    # factory for GUID primary keys
+    if settings.get('sql.guid_factory'):
+        from cone.sql.model import set_guid_factory
+        set_guid_factory(settings['sql.guid_factory'])
     global session_factory
     session_factory = SQLSessionFactory(settings, prefix)
     initialize_sql(session_factory.engine)
@@ -185,9 +322,15 @@ class SqlUGMFactory(UGMFactory):
         ]
         self.log_auth = settings.get('sql.log_auth') in ['true', 'True', '1']
         self.user_expires_attr = settings.get('sql.user_expires_attr')
+        self.login_cache_size = int(settings.get('sql.login_cache_size', 0))
+        self.legacy_login_lookup = settings.get('sql.legacy_login_lookup') in [
+            'true', 'True', '1'
+        ]
 
     def __call__(self):
         from cone.sql.ugm import Ugm
+        from cone.sql.ugm import login_cache
+        login_cache.size = self.login_cache_size
         return Ugm(
             name="sql_ugm",
             parent=None,
@@ -195,5 +338,6 @@ class SqlUGMFactory(UGMFactory):
             group_attrs=self.group_attrs,
             binary_attrs=self.binary_attrs,
             log_auth=self.log_auth,
-            user_expires_attr=self.user_expires_attr
+            user_expires_attr=self.user_expires_attr,
+            legacy_login_lookup=self.legacy_login_lookup
         )
@@ -1,7 +1,9 @@
+from cone.app.interfaces import IPrincipalACL
 from cone.app.security import PrincipalACL
 from cone.sql import get_session
 from cone.sql import SQLBase
 from cone.sql.model import GUID
+from cone.sql.model import new_guid
 from node.behaviors import DefaultInit
 from node.behaviors import MappingAdopt
 from node.behaviors import MappingConstraints
@@ -13,19 +15,128 @@ from plumber import plumbing
 from pyramid.threadlocal import get_current_request
 from sqlalchemy import and_
 from sqlalchemy import Column
+from sqlalchemy import delete
+from sqlalchemy import Index
+from sqlalchemy import insert
+from sqlalchemy import select
 from sqlalchemy import String
-import uuid
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 
 class PrincipalRoleRecord(SQLBase):
     __tablename__ = 'principal_roles'
+    __table_args__ = (
+        # unique index instead of unique constraint, it can be added to
+        # existing tables on all dialects. Also used for lookups by node.
+        Index(
+            'ix_principal_roles_node_id_principal_id_role',
+            'node_id',
+            'principal_id',
+            'role',
+            unique=True
+        ),
+        Index('ix_principal_roles_principal_id', 'principal_id'),
+    )
 
-    rec_id = Column(GUID, primary_key=True, default=lambda: uuid.uuid4())
+    rec_id = Column(GUID, primary_key=True, default=new_guid)
     node_id = Column(GUID)
     principal_id = Column(String)
     role = Column(String)
 
 
+# dialect specific insert constructs supporting ``ON CONFLICT DO NOTHING``
+insert_on_conflict = {
+    'postgresql': postgresql_insert,
+    'sqlite': sqlite_insert,
+}
+
+
+# key used for caching principal roles on request environment
+principal_roles_cache_key = 'cone.sql.principal_roles'
+
+
+def principal_roles_for(session, node_ids, principal_ids=None):
+    """Resolve principal roles for multiple nodes in one query.
+
+    Return a dict mapping node ids to dicts mapping principal ids to lists of
+    roles. If ``principal_ids`` given, the result is restricted to these
+    principals.
+    """
+    node_ids = set(node_ids)
+    result = {node_id: dict() for node_id in node_ids}
+    if not node_ids:
+        return result
+    query = session\
+        .query(
+            PrincipalRoleRecord.node_id,
+            PrincipalRoleRecord.principal_id,
+            PrincipalRoleRecord.role
+        )\
+        .filter(PrincipalRoleRecord.node_id.in_(node_ids))\
+        .order_by(
+            PrincipalRoleRecord.node_id,
+            PrincipalRoleRecord.principal_id,
+            PrincipalRoleRecord.role
+        )
+    if principal_ids is not None:
+        query = query.filter(
+            PrincipalRoleRecord.principal_id.in_(set(principal_ids))
+        )
+    for node_id, principal_id, role in query:
+        result[node_id].setdefault(principal_id, list()).append(role)
+    return result
+
+
+def principal_roles_cache(request):
+    """Return request related principal roles cache.
+
+    The cache is a dict mapping node ids to dicts mapping principal ids to
+    lists of roles.
+    """
+    return request.environ.setdefault(principal_roles_cache_key, dict())
+
+
+def prefetch_node_principal_roles(node_ids, request=None):
+    """Load principal roles of given node ids not cached yet in one query and
+    cache them on request.
+
+    Return the request related principal roles cache.
+    """
+    if request is None:
+        request = get_current_request()
+    cache = principal_roles_cache(request)
+    node_ids = set(node_ids).difference(cache)
+    if node_ids:
+        cache.update(principal_roles_for(get_session(request), node_ids))
+    return cache
+
+
+def prefetch_principal_roles(nodes, request=None):
+    """Load principal roles of multiple ``SQLPrincipalACL`` nodes in one
+    query and cache them on request.
+
+    Intended to be called by listings before checking permissions on the
+    listed nodes.
+    """
+    prefetch_node_principal_roles([node.uuid for node in nodes], request)
+
+
+def aggregated_principal_roles(node_ids, request=None):
+    """Return principal roles of given node ids merged into one dict mapping
+    principal ids to sets of roles.
+
+    Intended to be called with the node ids of a node lineage. Roles of nodes
+    not cached yet are loaded in one query and cached on request.
+    """
+    cache = prefetch_node_principal_roles(node_ids, request)
+    aggregated = dict()
+    for node_id in node_ids:
+        for principal_id, roles in cache[node_id].items():
+            aggregated.setdefault(principal_id, set()).update(roles)
+    return aggregated
+
+
 @plumbing(
     MappingConstraints,
     MappingAdopt,
@@ -40,64 +151,80 @@ class SQLPrincipalRoles(object):
     def session(self):
         return get_session(get_current_request())
 
+    @property
+    def _cache(self):
+        """Principal roles of node if already loaded for current request.
+        """
+        return principal_roles_cache(get_current_request()).get(
+            self.parent.uuid
+        )
+
+    @property
+    def _principal_roles(self):
+        """Principal roles of node. All principal roles of the node get
+        loaded with one query on first access and are cached on request.
+        """
+        node_id = self.parent.uuid
+        return prefetch_node_principal_roles([node_id])[node_id]
+
     def _roles_for(self, principal_id):
-        res = self.session\
-            .query(PrincipalRoleRecord.role)\
-            .filter(and_(
-                PrincipalRoleRecord.node_id == self.parent.uuid,
-                PrincipalRoleRecord.principal_id == principal_id
-            ))\
-            .distinct()
-        return [rec.role for rec in res]
+        return list(self._principal_roles.get(principal_id, list()))
 
     def __getitem__(self, name):
         return self._roles_for(name)
 
     def __setitem__(self, name, value):
         session = self.session
-        existing = self._roles_for(name)
-        for role in value:
-            if role not in existing:
-                session.add(PrincipalRoleRecord(
-                    node_id=self.parent.uuid,
-                    principal_id=name,
-                    role=role
+        node_id = self.parent.uuid
+        roles = list(dict.fromkeys(value))
+        record = PrincipalRoleRecord
+        stmt = delete(record).where(and_(
+            record.node_id == node_id,
+            record.principal_id == name
+        ))
+        if roles:
+            stmt = stmt.where(record.role.not_in(roles))
+        session.execute(stmt)
+        if roles:
+            new_roles = roles
+            dialect = session.bind.dialect.name
+            if dialect in insert_on_conflict:
+                stmt = insert_on_conflict[dialect](record.__table__)\
+                    .on_conflict_do_nothing()
+            else:
+                existing = set(session.scalars(
+                    select(record.role).where(and_(
+                        record.node_id == node_id,
+                        record.principal_id == name
+                    ))
                 ))
-        delete = list()
-        for role in existing:
-            if role not in value:
-                delete.append(role)
-        if delete:
-            res = session\
-                .query(PrincipalRoleRecord)\
-                .filter(and_(
-                    PrincipalRoleRecord.node_id == self.parent.uuid,
-                    PrincipalRoleRecord.principal_id == name,
-                    PrincipalRoleRecord.role.in_(delete)
-                ))\
-                .all()
-            for record in res:
-                session.delete(record)
+                new_roles = [role for role in roles if role not in existing]
+                stmt = insert(record.__table__)
+            if new_roles:
+                session.execute(stmt, [
+                    dict(node_id=node_id, principal_id=name, role=role)
+                    for role in new_roles
+                ])
+        cache = self._cache
+        if cache is not None:
+            if roles:
+                cache[name] = list(roles)
+            else:
+                cache.pop(name, None)
 
     def __delitem__(self, name):
         session = self.session
-        res = session\
-            .query(PrincipalRoleRecord)\
-            .filter(and_(
-                PrincipalRoleRecord.node_id == self.parent.uuid,
-                PrincipalRoleRecord.principal_id == name
-            ))\
-            .all()
-        for record in res:
-            session.delete(record)
+        session.execute(delete(PrincipalRoleRecord).where(and_(
+            PrincipalRoleRecord.node_id == self.parent.uuid,
+            PrincipalRoleRecord.principal_id == name
+        )))
+        cache = self._cache
+        if cache is not None:
+            cache.pop(name, None)
 
     def __iter__(self):
-        res = self.session\
-            .query(PrincipalRoleRecord.principal_id)\
-            .filter(PrincipalRoleRecord.node_id == self.parent.uuid)\
-            .distinct()
-        for rec in res:
-            yield rec.principal_id
+        # sorted to keep order independent from cached writes
+        return iter(sorted(self._principal_roles))
 
 
 class SQLPrincipalACL(PrincipalACL):
@@ -110,3 +237,23 @@ class SQLPrincipalACL(PrincipalACL):
         if not IUUID.providedBy(self):
             raise RuntimeError(u"%s does not implement IUUID" % str(self))
         return SQLPrincipalRoles(name='principal_roles', parent=self)
+
+    @default
+    @property
+    def aggregated_roles(self):
+        # resolve roles of all SQL principal ACL nodes in lineage at once
+        aggregated = dict()
+        node_ids = list()
+        model = self
+        while model:
+            if IPrincipalACL.providedBy(model):
+                principal_roles = model.principal_roles
+                if isinstance(principal_roles, SQLPrincipalRoles):
+                    node_ids.append(model.uuid)
+                else:
+                    for id, roles in principal_roles.items():
+                        aggregated.setdefault(id, set()).update(roles)
+            model = model.parent
+        for id, roles in aggregated_principal_roles(node_ids).items():
+            aggregated.setdefault(id, set()).update(roles)
+        return aggregated
@@ -0,0 +1,244 @@
+from cone.sql.acl import PrincipalRoleRecord
+from cone.sql.ugm import batched
+from sqlalchemy import insert
+import argparse
+import bisect
+import itertools
+import random
+import uuid
+
+
+###############################################################################
+# Synthetic UGM data
+###############################################################################
+
+# PNG file signature, prepended to generated portraits
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+class UgmDataGenerator(object):
+    """Deterministic synthetic data generator for SQL UGM scale testing.
+
+    Generates users, groups, group memberships and principal roles of ACL
+    nodes. Generated data only depends on the given arguments and ``seed``.
+    Principal guids are generated on insert and not covered by the seed.
+
+    Group sizes follow a power law. The group at rank ``k`` gets chosen with
+    weight ``1 / (k + 1) ** alpha`` for memberships, thus the first groups
+    become huge while most groups have few members.
+    """
+
+    def __init__(
+        self,
+        users=1000,
+        groups=100,
+        memberships=5,
+        alpha=1.0,
+        portraits=0.1,
+        portrait_size=4096,
+        portrait_attr='portrait',
+        acl_nodes=0,
+        acl_principals=5,
+        roles=('viewer', 'editor', 'manager'),
+        seed=0
+    ):
+        self.user_count = users
+        self.group_count = groups
+        self.memberships_per_user = memberships
+        self.alpha = alpha
+        self.portraits = portraits
+        self.portrait_size = portrait_size
+        self.portrait_attr = portrait_attr
+        self.acl_nodes = acl_nodes
+        self.acl_principals = acl_principals
+        self.roles = list(roles)
+        self.seed = seed
+
+    def random(self, name):
+        """Return random generator for data stream with name.
+
+        Each stream uses its own generator, thus streams are deterministic
+        regardless of the order they get consumed.
+        """
+        return random.Random('{}-{}'.format(self.seed, name))
+
+    @property
+    def user_ids(self):
+        return ['user_{:07d}'.format(i) for i in range(self.user_count)]
+
+    @property
+    def group_ids(self):
+        return ['group_{:05d}'.format(i) for i in range(self.group_count)]
+
+    def users(self):
+        """Yield ``(id, attrs)`` tuples of users.
+        """
+        rng = self.random('users')
+        for i, user_id in enumerate(self.user_ids):
+            attrs = {
+                'fullname': 'User {}'.format(i),
+                'email': '{}@example.com'.format(user_id),
+                'login': 'email',
+            }
+            if rng.random() < self.portraits:
+                attrs[self.portrait_attr] = PNG_SIGNATURE + rng.randbytes(
+                    max(self.portrait_size - len(PNG_SIGNATURE), 0)
+                )
+            yield user_id, attrs
+
+    def groups(self):
+        """Yield ``(id, attrs)`` tuples of groups.
+        """
+        for i, group_id in enumerate(self.group_ids):
+            yield group_id, {'groupname': 'Group {}'.format(i)}
+
+    def memberships(self):
+        """Yield ``(group_id, user_id)`` tuples.
+
+        Each user is member of ``memberships`` groups on average.
+        """
+        group_ids = self.group_ids
+        if not group_ids:
+            return
+        rng = self.random('memberships')
+        cum_weights = list(itertools.accumulate(
+            1. / (rank + 1) ** self.alpha
+            for rank in range(len(group_ids))
+        ))
+        total = cum_weights[-1]
+        for user_id in self.user_ids:
+            count = rng.randint(0, 2 * self.memberships_per_user)
+            indices = set()
+            # bounded number of draws, huge groups get drawn repeatedly
+            for _ in range(count * 2):
+                if len(indices) == min(count, len(group_ids)):
+                    break
+                index = bisect.bisect(cum_weights, rng.random() * total)
+                indices.add(min(index, len(group_ids) - 1))
+            for index in sorted(indices):
+                yield group_ids[index], user_id
+
+    def principal_roles(self):
+        """Yield ``principal_roles`` table rows for ACL nodes.
+        """
+        if not self.roles:
+            return
+        rng = self.random('principal_roles')
+        principal_ids = self.user_ids + [
+            'group:{}'.format(group_id) for group_id in self.group_ids
+        ]
+        count = min(self.acl_principals, len(principal_ids))
+        for _ in range(self.acl_nodes):
+            node_id = uuid.UUID(int=rng.getrandbits(128), version=4)
+            for principal_id in rng.sample(principal_ids, count):
+                yield dict(
+                    rec_id=uuid.UUID(int=rng.getrandbits(128), version=4),
+                    node_id=node_id,
+                    principal_id=principal_id,
+                    role=rng.choice(self.roles)
+                )
+
+    def __call__(self, ugm, batch_size=1000):
+        """Write generated data to SQL UGM with bulk inserts.
+
+        Changes are not committed. Raises ``ValueError`` if portraits get
+        generated and ``portrait_attr`` is no binary attribute of ``ugm``.
+        """
+        if self.portraits and \
+                self.portrait_attr not in ugm.attr_set('binary_attrs'):
+            raise ValueError(
+                'Portrait attribute "{}" is no binary attribute'.format(
+                    self.portrait_attr
+                )
+            )
+        ugm.import_principals(
+            users=self.users(),
+            groups=self.groups(),
+            memberships=self.memberships(),
+            batch_size=batch_size
+        )
+        session = ugm.session
+        for batch in batched(self.principal_roles(), batch_size):
+            session.execute(insert(PrincipalRoleRecord), batch)
+
+
+###############################################################################
+# Command line
+###############################################################################
+
+def main(argv=None):
+    """Generate synthetic UGM data for application config.
+
+    Usage: ``cone_sql_generate app.ini#app_name --users 100000``
+    """
+    from cone import sql
+    from cone.app import ugm_backend
+    from pyramid.paster import bootstrap
+
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic SQL UGM data.'
+    )
+    parser.add_argument('config_uri', help='Application config file.')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument(
+        '--memberships',
+        type=int,
+        default=5,
+        help='Average number of group memberships per user.'
+    )
+    parser.add_argument(
+        '--alpha',
+        type=float,
+        default=1.0,
+        help='Power law exponent of group sizes.'
+    )
+    parser.add_argument(
+        '--portraits',
+        type=float,
+        default=0.1,
+        help='Ratio of users with portrait.'
+    )
+    parser.add_argument('--portrait-size', type=int, default=4096)
+    parser.add_argument(
+        '--portrait-attr',
+        default='portrait',
+        help='Binary user attribute portraits are stored in.'
+    )
+    parser.add_argument(
+        '--acl-nodes',
+        type=int,
+        default=0,
+        help='Number of ACL nodes to create principal roles for.'
+    )
+    parser.add_argument(
+        '--acl-principals',
+        type=int,
+        default=5,
+        help='Number of principals with a role per ACL node.'
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    env = bootstrap(args.config_uri)
+    session = sql.session_factory()
+    try:
+        env['request'].environ[sql.session_key] = session
+        generator = UgmDataGenerator(
+            users=args.users,
+            groups=args.groups,
+            memberships=args.memberships,
+            alpha=args.alpha,
+            portraits=args.portraits,
+            portrait_size=args.portrait_size,
+            portrait_attr=args.portrait_attr,
+            acl_nodes=args.acl_nodes,
+            acl_principals=args.acl_principals,
+            seed=args.seed
+        )
+        generator(ugm_backend.ugm, batch_size=args.batch_size)
+        session.commit()
+    finally:
+        session.close()
+        env['closer']()
@@ -0,0 +1,115 @@
+from cone.sql import metadata
+from cone.sql.acl import PrincipalRoleRecord
+from cone.sql.ugm import SQLGroup
+from cone.sql.ugm import SQLPrincipal
+from cone.sql.ugm import SQLPrincipalBinary
+from cone.sql.ugm import SQLUser
+from cone.sql.ugm import SQLUserLogin
+from cone.sql.ugm import login_value
+from cone.sql.ugm import logins_changed
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from sqlalchemy.orm import with_polymorphic
+from sqlalchemy.orm.attributes import flag_modified
+import base64
+
+
+###############################################################################
+# Schema
+###############################################################################
+
+def create_indexes(engine):
+    """Create missing tables and indexes.
+
+    ``metadata.create_all`` creates indexes only along with newly created
+    tables. Call this function to add indexes introduced later to existing
+    databases. ``engine`` can also be a connection.
+    """
+    metadata.create_all(engine)
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
+###############################################################################
+# UGM
+###############################################################################
+
+def rebuild_user_logins(session):
+    """Rebuild the normalized user login lookup table.
+
+    Needs to be called once for databases containing users created before
+    the ``user_login`` table was introduced. Changes are not committed.
+    """
+    session.query(SQLUserLogin).delete()
+    for record in session.query(SQLUser).filter(SQLUser.login.isnot(None)):
+        value = login_value(record.login, record.data)
+        if value is not None:
+            session.add(SQLUserLogin(user_guid=record.guid, login=value))
+    session.flush()
+    logins_changed(session)
+
+
+def migrate_binary_attrs(session, binary_attrs):
+    """Move base64 encoded binary attributes from ``data`` of principals to
+    the ``principal_binary`` table.
+
+    Needs to be called once for databases containing principals created
+    before the ``principal_binary`` table was introduced. Changes are not
+    committed.
+    """
+    # load user and group columns in the same query, flushing users reads
+    # their login
+    principals = with_polymorphic(SQLPrincipal, [SQLUser, SQLGroup])
+    for record in session.query(principals):
+        data = record.data
+        names = [name for name in binary_attrs if data and name in data]
+        if not names:
+            continue
+        for name in names:
+            value = data.pop(name)
+            if value:
+                record.binaries[name] = SQLPrincipalBinary(
+                    name=name,
+                    value=base64.b64decode(value)
+                )
+        flag_modified(record, 'data')
+    session.flush()
+
+
+###############################################################################
+# ACL
+###############################################################################
+
+def migrate_principal_roles(engine):
+    """Remove duplicate principal role records and create the indexes of the
+    ``principal_roles`` table.
+
+    Needs to be called once for databases created before the unique index on
+    ``node_id``, ``principal_id`` and ``role`` was introduced. ``engine`` can
+    also be a connection. Changes then join its transaction and are not
+    committed.
+    """
+    session = Session(bind=engine)
+    try:
+        record = PrincipalRoleRecord
+        duplicates = session\
+            .query(record.node_id, record.principal_id, record.role)\
+            .group_by(record.node_id, record.principal_id, record.role)\
+            .having(func.count() > 1)\
+            .all()
+        for node_id, principal_id, role in duplicates:
+            rec_ids = session\
+                .query(record.rec_id)\
+                .filter(record.node_id == node_id)\
+                .filter(record.principal_id == principal_id)\
+                .filter(record.role == role)\
+                .all()
+            session\
+                .query(record)\
+                .filter(record.rec_id.in_([rec[0] for rec in rec_ids[1:]]))\
+                .delete(synchronize_session=False)
+        session.commit()
+    finally:
+        session.close()
+    create_indexes(engine)
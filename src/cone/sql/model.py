@@ -1,6 +1,6 @@
 from cone.app.model import AppNode
 from cone.sql import get_session
-from cone.sql import use_tm
+from cone.sql import persist_session
 from node.behaviors import Attributes
 from node.behaviors import DefaultInit
 from node.behaviors import Lifecycle
@@ -15,14 +15,25 @@ from plumber import finalize
 from plumber import override
 from plumber import plumbing
 from pyramid.threadlocal import get_current_request
+from sqlalchemy import and_
+from sqlalchemy import delete
 from sqlalchemy import inspect
 from sqlalchemy import Integer
 from sqlalchemy import String
+from sqlalchemy import or_
+from sqlalchemy import update
 from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.types import BINARY
 from sqlalchemy.types import CHAR
 from sqlalchemy.types import TypeDecorator
 from zope.interface import implementer
+import base64
+import datetime
+import itertools
+import json
+import os
 import sys
+import time
 import uuid
 
 
@@ -44,14 +55,26 @@ class GUID(TypeDecorator):
     Uses Postgresql's UUID type, otherwise uses
     CHAR(32), storing as stringified hex values.
 
+    If ``binary`` is True, BINARY(16) storing the raw UUID bytes is used
+    instead of CHAR(32), which halves the size of keys and indexes. If not
+    given, the class default ``GUID.binary`` is used.
+
     http://docs.sqlalchemy.org/en/rel_0_8/core/types.html#backend-agnostic-guid-type
     """
     impl = CHAR
     cache_ok = True
+    binary = False
+
+    def __init__(self, binary=None):
+        super(GUID, self).__init__()
+        if binary is not None:
+            self.binary = binary
 
     def load_dialect_impl(self, dialect):
         if dialect.name == 'postgresql':
-            return dialect.type_descriptor(UUID())
+            return dialect.type_descriptor(UUID(as_uuid=True))
+        elif self.binary:
+            return dialect.type_descriptor(BINARY(16))
         else:
             return dialect.type_descriptor(CHAR(32))
 
@@ -62,17 +85,313 @@ class GUID(TypeDecorator):
             return str(value)
         else:
             if not isinstance(value, uuid.UUID):
-                return "%.32x" % int(uuid.UUID(value))
-            else:
-                # hexstring
-                return "%.32x" % int(value)
+                value = uuid.UUID(value)
+            if self.binary:
+                return value.bytes
+            # hexstring
+            return value.hex
 
     def process_result_value(self, value, dialect):
-        if value is None:
+        if value is None or isinstance(value, uuid.UUID):
             return value
+        elif self.binary and dialect.name != 'postgresql':
+            return uuid.UUID(bytes=bytes(value))
         else:
             return uuid.UUID(value)
 
+    def result_processor(self, dialect, coltype):
+        # Build converter once per dialect instead of dispatching to
+        # ``process_result_value`` and checking the dialect for each row.
+        UUID_ = uuid.UUID
+        if dialect.name == 'postgresql':
+            # UUID impl or driver most likely return ``uuid.UUID`` already
+            def convert(value):
+                return value if isinstance(value, UUID_) else UUID_(value)
+        elif self.binary:
+            def convert(value):
+                return UUID_(bytes=bytes(value))
+        else:
+            def convert(value):
+                # parsing hex value to int skips string normalization
+                try:
+                    return UUID_(int=int(value, 16))
+                except ValueError:
+                    return UUID_(value)
+        impl_processor = self.impl_instance.result_processor(dialect, coltype)
+        if impl_processor:
+            def process(value):
+                value = impl_processor(value)
+                return None if value is None else convert(value)
+        else:
+            def process(value):
+                return None if value is None else convert(value)
+        return process
+
+
+###############################################################################
+# GUID generation
+###############################################################################
+
+def uuid7():
+    """Create time ordered UUID version 7 as specified in RFC 9562.
+
+    The first 48 bits contain the unix timestamp in milliseconds, thus
+    subsequently created keys are inserted close to each other in indexes.
+    """
+    timestamp = time.time_ns() // 1000000
+    rand = int.from_bytes(os.urandom(10), 'big')
+    value = (timestamp & 0xffffffffffff) << 80
+    value |= 0x7 << 76
+    value |= (rand >> 64 & 0xfff) << 64
+    value |= 0x2 << 62
+    value |= rand & 0x3fffffffffffffff
+    return uuid.UUID(int=value)
+
+
+# available GUID factories by name
+guid_factories = {
+    'uuid4': uuid.uuid4,
+    'uuid7': uuid7,
+}
+
+# factory used for creating GUID's
+guid_factory = uuid.uuid4
+
+
+def set_guid_factory(name):
+    """Set factory used by ``new_guid`` by name.
+    """
+    try:
+        factory = guid_factories[name]
+    except KeyError:
+        raise ValueError('Unknown GUID factory: {}'.format(name))
+    global guid_factory
+    guid_factory = factory
+
+
+def new_guid():
+    """Create new GUID with configured factory.
+
+    Used as default for ``GUID`` primary key columns of ``cone.sql`` models.
+    """
+    return guid_factory()
+
+
+###############################################################################
+# Keyset pagination
+###############################################################################
+
+def parse_sort(record_class, sort):
+    """Parse sort spec into list of ``(column, descending)`` tuples.
+
+    ``sort`` is a list of column attribute names. Names prefixed with ``-``
+    are sorted descending. Raises ``ValueError`` on unknown columns.
+    """
+    if isinstance(sort, str):
+        sort = [sort]
+    columns = inspect(record_class).column_attrs
+    spec = list()
+    for name in sort or []:
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        if name not in columns:
+            raise ValueError('Unknown sort column: {}'.format(name))
+        spec.append((getattr(record_class, name), descending))
+    return spec
+
+
+def keyset_order(spec):
+    """Return order by clauses for parsed sort spec.
+    """
+    return [
+        column.desc() if descending else column.asc()
+        for column, descending in spec
+    ]
+
+
+def keyset_clause(spec, values):
+    """Return clause selecting rows after ``values`` in parsed sort spec.
+
+    Compiles to ``c1 > v1 OR (c1 = v1 AND c2 > v2) OR ...``, which works
+    with mixed sort directions on all dialects.
+    """
+    clauses = list()
+    for index, (column, descending) in enumerate(spec):
+        value = values[index]
+        after = column < value if descending else column > value
+        equals = [c == v for (c, _), v in zip(spec[:index], values)]
+        clauses.append(and_(*equals, after))
+    return or_(*clauses)
+
+
+def _token_value(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def _column_value(column, value):
+    if value is None:
+        return value
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:  # pragma: no cover
+        return value
+    if isinstance(value, python_type):
+        return value
+    if python_type in (datetime.datetime, datetime.date, datetime.time):
+        return python_type.fromisoformat(value)
+    return python_type(value)
+
+
+def encode_page_token(sort, values):
+    """Encode opaque continuation token for sort spec and sort values.
+    """
+    data = json.dumps([list(sort), [_token_value(v) for v in values]])
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_page_token(spec, sort, token):
+    """Decode continuation token to sort values of parsed sort spec.
+
+    Raises ``ValueError`` if token is invalid or was created for another
+    sort spec.
+    """
+    try:
+        token_sort, values = json.loads(base64.urlsafe_b64decode(token))
+    except Exception:
+        raise ValueError('Invalid continuation token')
+    if token_sort != list(sort) or len(values) != len(spec):
+        raise ValueError('Continuation token does not match sort')
+    return [
+        _column_value(column, value)
+        for (column, _), value in zip(spec, values)
+    ]
+
+
+###############################################################################
+# Query pushdown
+###############################################################################
+
+# operators of filter criteria, given as suffix of the column name separated
+# by ``__``.
+filter_operators = {
+    'eq': lambda column, value: column == value,
+    'ne': lambda column, value: column != value,
+    'lt': lambda column, value: column < value,
+    'le': lambda column, value: column <= value,
+    'gt': lambda column, value: column > value,
+    'ge': lambda column, value: column >= value,
+    'in': lambda column, value: column.in_(value),
+    'like': lambda column, value: column.like(value),
+    'ilike': lambda column, value: column.ilike(value),
+}
+
+
+def filter_clauses(record_class, criteria):
+    """Compile filter criteria to list of SQL clauses.
+
+    Keys of ``criteria`` are column attribute names, optionally suffixed
+    with an operator from ``filter_operators``, e.g. ``rank__gt``. Raises
+    ``ValueError`` on unknown columns or operators.
+    """
+    columns = inspect(record_class).column_attrs
+    clauses = list()
+    for key, value in criteria.items():
+        name, _, operator = key.partition('__')
+        operator = operator or 'eq'
+        if name not in columns:
+            raise ValueError('Unknown filter column: {}'.format(name))
+        if operator not in filter_operators:
+            raise ValueError('Unknown filter operator: {}'.format(operator))
+        column = getattr(record_class, name)
+        clauses.append(filter_operators[operator](column, value))
+    return clauses
+
+
+class SQLTableResult(object):
+    """Lazily evaluated query result of SQL table storage child nodes.
+
+    The query is executed when iterating, indexing or counting. Slicing and
+    ordering return new results. Slice bounds are kept separately from the
+    query, thus ordering a sliced result orders before slicing.
+    """
+
+    def __init__(self, storage, query, start=0, stop=None):
+        self.storage = storage
+        self.query = query
+        self.start = start
+        self.stop = stop
+
+    @property
+    def sliced_query(self):
+        """Query with slice bounds applied.
+        """
+        if self.stop is not None:
+            return self.query.slice(self.start, self.stop)
+        if self.start:
+            return self.query.offset(self.start)
+        return self.query
+
+    def order_by(self, *sort):
+        """Return result ordered by column names. Names prefixed with ``-``
+        are sorted descending.
+        """
+        spec = parse_sort(self.storage.record_class, list(sort))
+        return SQLTableResult(
+            self.storage,
+            self.query.order_by(*keyset_order(spec)),
+            start=self.start,
+            stop=self.stop
+        )
+
+    def count(self):
+        # no ``__len__``, ``list(result)`` would issue a count query
+        return self.sliced_query.count()
+
+    def __iter__(self):
+        storage = self.storage
+        for record in self.sliced_query:
+            yield storage._child_for(record)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.step not in (None, 1) or \
+                    (index.start or 0) < 0 or \
+                    (index.stop or 0) < 0:
+                raise ValueError('Only positive slices without step allowed')
+            start = self.start + (index.start or 0)
+            stop = self.stop
+            if index.stop is not None:
+                stop = self.start + index.stop
+                if self.stop is not None:
+                    stop = min(stop, self.stop)
+            if stop is not None:
+                stop = max(stop, start)
+            return SQLTableResult(self.storage, self.query, start, stop)
+        if index < 0:
+            raise IndexError('Negative index not allowed')
+        offset = self.start + index
+        if self.stop is not None and offset >= self.stop:
+            raise IndexError(index)
+        record = self.query.offset(offset).limit(1).first()
+        if record is None:
+            raise IndexError(index)
+        return self.storage._child_for(record)
+
+    def first(self):
+        """Return first child node or None.
+        """
+        try:
+            return self[0]
+        except IndexError:
+            return None
+
+    def keys(self):
+        return [node.name for node in self]
+
 
 ###############################################################################
 # SQL table storage
@@ -171,12 +490,160 @@ class SQLTableStorage(Behavior):
         for recid in result.all():
             yield str(recid[0])
 
+    @default
+    def page(self, sort=None, after=None, size=20):
+        """Return page of child nodes and continuation token.
+
+        ``sort`` is a list of column names, names prefixed with ``-`` are
+        sorted descending. The primary key is appended as tie breaker. Sort
+        columns should be indexed and not nullable.
+
+        ``after`` is the continuation token returned for the previous page.
+        Pages are selected by comparing sort column values instead of using
+        an offset, thus deep pages are as fast as the first one.
+
+        Returns ``(nodes, token)`` tuple. ``token`` is None on last page.
+        """
+        # XXX: multiple primary key support
+        primary_key = self.primary_key[0]
+        record_class = self.record_class
+        sort = [sort] if isinstance(sort, str) else list(sort or [])
+        key_name = primary_key.name
+        if key_name not in [name.lstrip('-') for name in sort]:
+            sort.append(key_name)
+        spec = parse_sort(record_class, sort)
+        query = self.session.query(record_class)
+        if after is not None:
+            values = decode_page_token(spec, sort, after)
+            query = query.filter(keyset_clause(spec, values))
+        records = query.order_by(*keyset_order(spec)).limit(size + 1).all()
+        token = None
+        if len(records) > size:
+            records = records[:size]
+            last = records[-1]
+            token = encode_page_token(sort, [
+                getattr(last, column.key) for column, _ in spec
+            ])
+        return [self._child_for(record) for record in records], token
+
+    @default
+    def filter(self, **criteria):
+        """Return lazy ``SQLTableResult`` of children matching criteria.
+
+        Keys are column names, optionally suffixed with an operator, e.g.
+        ``container.filter(rank__gt=1, title__like='A%')``. Supported
+        operators are ``eq``, ``ne``, ``lt``, ``le``, ``gt``, ``ge``, ``in``,
+        ``like`` and ``ilike``.
+        """
+        return self.query(*filter_clauses(self.record_class, criteria))
+
+    @default
+    def query(self, *clauses):
+        """Return lazy ``SQLTableResult`` of children matching SQLAlchemy
+        clauses.
+        """
+        query = self.session.query(self.record_class)
+        if clauses:
+            query = query.filter(*clauses)
+        return SQLTableResult(self, query)
+
+    @default
+    def delete_many(self, names, synchronize_session='auto', batch_size=1000):
+        """Delete children by names with bulk ``DELETE`` statements.
+
+        Names are deleted in batches of ``batch_size``. Inexistent names
+        are ignored. Returns the number of deleted rows.
+
+        ORM cascades and mapper events are not triggered.
+        ``synchronize_session`` is passed to SQLAlchemy and defines how
+        deleted records are removed from the session.
+        """
+        # XXX: multiple primary key support
+        primary_key = self.primary_key[0]
+        column = getattr(self.record_class, primary_key.name)
+        values = iter([self._convert_primary_key(name) for name in names])
+        count = 0
+        while True:
+            batch = list(itertools.islice(values, batch_size))
+            if not batch:
+                return count
+            count += self._execute_bulk(
+                delete(self.record_class).where(column.in_(batch)),
+                synchronize_session
+            )
+
+    @default
+    def delete_where(self, criteria, synchronize_session='auto', all=False):
+        """Delete children matching filter criteria with one ``DELETE``
+        statement. See ``filter`` for the criteria format.
+
+        Empty criteria raise a ``ValueError`` unless ``all`` is set, which
+        deletes all children.
+
+        Returns the number of deleted rows. ORM cascades and mapper events
+        are not triggered.
+        """
+        record_class = self.record_class
+        clauses = self._bulk_clauses(criteria, all)
+        return self._execute_bulk(
+            delete(record_class).where(*clauses),
+            synchronize_session
+        )
+
+    @default
+    def update_where(
+        self,
+        criteria,
+        values,
+        synchronize_session='auto',
+        all=False
+    ):
+        """Update children matching filter criteria with one ``UPDATE``
+        statement. ``values`` is a dict of column names and values.
+
+        Empty criteria raise a ``ValueError`` unless ``all`` is set, which
+        updates all children.
+
+        Returns the number of updated rows. Mapper events are not
+        triggered.
+        """
+        record_class = self.record_class
+        clauses = self._bulk_clauses(criteria, all)
+        columns = inspect(record_class).column_attrs
+        for name in values:
+            if name not in columns:
+                raise ValueError('Unknown update column: {}'.format(name))
+        return self._execute_bulk(
+            update(record_class).where(*clauses).values(**values),
+            synchronize_session
+        )
+
+    @default
+    def _bulk_clauses(self, criteria, all):
+        # refuse to touch the whole table by accident
+        if not criteria and not all:
+            raise ValueError(
+                'Empty criteria, pass ``all=True`` to affect all children'
+            )
+        return filter_clauses(self.record_class, criteria)
+
+    @default
+    def _execute_bulk(self, statement, synchronize_session):
+        statement = statement.execution_options(
+            synchronize_session=synchronize_session
+        )
+        return self.session.execute(statement).rowcount
+
+    @default
+    def _child_for(self, record):
+        # XXX: multiple primary key support
+        primary_key = self.primary_key[0]
+        name = str(getattr(record, primary_key.name))
+        return self.child_factory(name, self, record)
+
     @finalize
     def __call__(self):
-        if use_tm():
-            self.session.flush()
-        else:
-            self.session.commit()
+        persist_session(self.session)
 
 
 ###############################################################################
@@ -259,10 +726,7 @@ class SQLRowStorage(Behavior):
         if self._new:
             session.add(self.record)
             self._new = False
-        if use_tm():
-            self.session.flush()
-        else:
-            self.session.commit()
+        persist_session(self.session)
 
 
 ###############################################################################
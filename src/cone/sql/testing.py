@@ -3,14 +3,18 @@ from cone.app.testing import Security
 from cone.app.ugm import ugm_backend
 from cone.sql import get_session
 from cone.sql import initialize_sql
+from cone.sql import metadata
 from cone.sql import setup_session
 from cone.sql import sql_session_setup
 from cone.ugm import testing
 from sqlalchemy import create_engine
 from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
 from sqlalchemy.orm import sessionmaker
 import os
 import shutil
+import sqlite3
 import tempfile
 
 
@@ -57,6 +61,210 @@ class delete_table_records(object):
         return wrapper
 
 
+def transactional(fn):
+    """Run test in a transaction which gets rolled back afterwards.
+
+    The SQL session of the layer gets replaced by a session joined to an
+    outer transaction. ``commit`` and ``rollback`` calls of the test only
+    release or roll back savepoints, thus no cleanup of table records is
+    required.
+
+    Code under test must use the bind of the layer session instead of
+    connecting to the engine. The in-memory SQLite database of the default
+    test backend uses one shared DBAPI connection, which is already in the
+    outer transaction, thus a second connection would fail to ``BEGIN``.
+    DDL executed on the bind gets rolled back as well.
+    """
+    def wrapper(inst):
+        layer = inst.layer
+        layer_session = layer.sql_session
+        layer_session.close()
+        connection = layer_session.bind.connect()
+        transaction = connection.begin()
+        session = Session(
+            bind=connection,
+            join_transaction_mode='create_savepoint'
+        )
+        setup_session(session)
+        layer.sql_session = session
+        try:
+            fn(inst)
+        finally:
+            layer.sql_session = layer_session
+            session.close()
+            transaction.rollback()
+            connection.close()
+            # current request must not refer to the closed session
+            layer.new_request()
+    return wrapper
+
+
+class QueryCounter(object):
+    """Context manager counting and recording SQL statements executed on
+    engine.
+
+    Savepoint statements emitted in ``transactional`` tests are not counted.
+    """
+    savepoint_statements = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO')
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self.statements = []
+
+    def __call__(self, conn, cursor, statement, *args):
+        if not statement.startswith(self.savepoint_statements):
+            self.count += 1
+            self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, 'before_cursor_execute', self)
+
+
+###############################################################################
+# Database templates
+###############################################################################
+
+def get_worker_id():
+    """Return id of parallel test worker process or None.
+
+    Read from ``CONE_SQL_TEST_WORKER`` environment variable, falls back to
+    the worker id set by ``pytest-xdist``.
+    """
+    return (
+        os.environ.get('CONE_SQL_TEST_WORKER')
+        or os.environ.get('PYTEST_XDIST_WORKER')
+        or None
+    )
+
+
+def worker_db_name(name):
+    """Return database name suffixed with test worker id if tests run in
+    parallel, thus each worker uses its own database.
+    """
+    worker_id = get_worker_id()
+    if not worker_id:
+        return name
+    base, ext = os.path.splitext(name)
+    return '{}_{}{}'.format(base, worker_id, ext)
+
+
+def sqlite_savepoints(engine):
+    """Let SQLAlchemy emit ``BEGIN`` instead of the pysqlite driver.
+
+    pysqlite defers ``BEGIN`` until the first DML statement, which breaks
+    ``SAVEPOINT`` based nested transactions.
+    """
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        # bypass cursor execute events, driver emitted ``BEGIN`` statements
+        # are not visible to them either
+        connection.connection.driver_connection.execute('BEGIN')
+
+
+class DatabaseTemplate(object):
+    """Database containing schema and seed data which is created once and
+    cloned for test layers or tests.
+
+    SQLite databases are cloned using the backup API, PostgreSQL databases
+    with ``CREATE DATABASE ... TEMPLATE``.
+    """
+
+    def __init__(self, url, seed=None):
+        self.url = make_url(url)
+        self.seed = seed
+        self.created = False
+
+    @property
+    def sqlite(self):
+        return self.url.get_backend_name() == 'sqlite'
+
+    def create(self):
+        """Create template database if not created yet.
+        """
+        if self.created:
+            return
+        if self.sqlite:
+            if os.path.exists(self.url.database):
+                os.remove(self.url.database)
+        else:
+            name = self.url.database
+            self._admin_execute(
+                'DROP DATABASE IF EXISTS "{}"'.format(name),
+                'CREATE DATABASE "{}"'.format(name)
+            )
+        engine = create_engine(self.url)
+        try:
+            metadata.create_all(engine)
+            if self.seed is not None:
+                with Session(engine) as session:
+                    self.seed(session)
+                    session.commit()
+        finally:
+            engine.dispose()
+        self.created = True
+
+    def clone(self, name):
+        """Create database with name from template and return its URL.
+
+        An existing database with this name gets replaced. For SQLite,
+        ``name`` is the file name of the database next to the template.
+        """
+        self.create()
+        if self.sqlite:
+            path = os.path.join(os.path.dirname(self.url.database), name)
+            source = sqlite3.connect(self.url.database)
+            target = sqlite3.connect(path)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+                source.close()
+            return self.url.set(database=path)
+        self._admin_execute(
+            'DROP DATABASE IF EXISTS "{}"'.format(name),
+            'CREATE DATABASE "{}" TEMPLATE "{}"'.format(
+                name,
+                self.url.database
+            )
+        )
+        return self.url.set(database=name)
+
+    def _admin_execute(self, *statements):
+        engine = create_engine(
+            self.url.set(database='postgres'),
+            isolation_level='AUTOCOMMIT'
+        )
+        try:
+            with engine.connect() as connection:
+                for statement in statements:
+                    connection.exec_driver_sql(statement)
+        finally:
+            engine.dispose()
+
+
+# Database templates by URL and seed function, created once per process.
+_database_templates = dict()
+
+
+def database_template(url, seed=None):
+    """Return database template for URL and seed function.
+    """
+    key = (str(url), seed)
+    template = _database_templates.get(key)
+    if template is None:
+        template = _database_templates[key] = DatabaseTemplate(url, seed)
+    return template
+
+
 ###############################################################################
 # Test SQL session factory
 ###############################################################################
@@ -110,23 +318,45 @@ class SQLLayer(testing.UGMLayer):
         request.environ['cone.sql.session'] = self.sql_session
         return request
 
+    def seed_sql(self, session):
+        """Add fixture data to database template.
+
+        Override in subclasses. Data gets created once and is cloned with the
+        template database if a persistent test backend is used.
+        """
+
     def init_sql(self):
         sql_backend = os.environ.get('CONE_SQL_TEST_BACKEND')
         # sqlite memory is default test backend
         if not sql_backend:  # pragma no cover
             engine = create_engine('sqlite:///:memory:', echo=False)
+            sqlite_savepoints(engine)
+            with Session(engine) as session:
+                metadata.create_all(engine)
+                self.seed_sql(session)
+                session.commit()
         # sqlite persistent in package folder for post mortem analysis
         elif sql_backend == 'sqlite':  # pragma no cover
             curdir = os.path.dirname(__file__)
-            fname = "%s/test.db" % curdir
-            if os.path.exists(fname):
-                os.remove(fname)
-            uri = "sqlite:///" + fname
-            engine = create_engine(uri)
-        # alternatively use postgresql - ditches db before start
+            template = database_template(
+                'sqlite:///{}/{}'.format(
+                    curdir,
+                    worker_db_name('test_template.db')
+                ),
+                seed=self.seed_sql
+            )
+            engine = create_engine(template.clone(worker_db_name('test.db')))
+            sqlite_savepoints(engine)
+        # alternatively use postgresql - database gets cloned from template
         elif sql_backend == 'postgres':  # pragma no cover
-            os.system("dropdb ugm; createdb ugm")
-            engine = create_engine("postgresql:///ugm", echo=False)
+            template = database_template(
+                'postgresql:///{}'.format(worker_db_name('ugm_template')),
+                seed=self.seed_sql
+            )
+            engine = create_engine(
+                template.clone(worker_db_name('ugm')),
+                echo=False
+            )
         initialize_sql(engine)
         maker = sessionmaker(bind=engine)
         if sql.session_factory:  # pragma no cover
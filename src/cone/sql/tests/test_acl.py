@@ -1,13 +1,18 @@
 from cone.sql import get_session
+from cone.sql import acl
 from cone.sql import testing
 from cone.sql.acl import PrincipalRoleRecord
 from cone.sql.acl import SQLPrincipalACL
 from cone.sql.acl import SQLPrincipalRoles
+from cone.sql.acl import aggregated_principal_roles
+from cone.sql.acl import prefetch_principal_roles
+from cone.sql.acl import principal_roles_for
 from node.base import BaseNode
 from node.interfaces import IUUID
 from node.tests import NodeTestCase
 from plumber import plumbing
 from pyramid.security import Allow
+from sqlalchemy.exc import IntegrityError
 from zope.interface import implementer
 import uuid as uuid_module
 
@@ -84,20 +89,20 @@ class TestACL(NodeTestCase):
             ['editor', 'manager']
         )
 
-        # check __acl__ on node
+        # check __acl__ on node. Principals are ordered by principal id
         acl = node.__acl__
         self.assertEqual(len(acl), 5)
         self.assertEqual(acl[0][0], 'Allow')
-        self.assertEqual(acl[0][1], 'someuser')
-        self.assertEqual(acl[0][2], ['manage'])
+        self.assertEqual(acl[0][1], 'group:some_group')
+        self.assertEqual(sorted(acl[0][2]), ['edit', 'manage'])
 
         self.assertEqual(acl[1][0], 'Allow')
         self.assertEqual(acl[1][1], 'otheruser')
         self.assertEqual(acl[1][2], ['edit'])
 
         self.assertEqual(acl[2][0], 'Allow')
-        self.assertEqual(acl[2][1], 'group:some_group')
-        self.assertEqual(sorted(acl[2][2]), ['edit', 'manage'])
+        self.assertEqual(acl[2][1], 'someuser')
+        self.assertEqual(acl[2][2], ['manage'])
 
         self.assertEqual(acl[3][0], 'Allow')
         self.assertEqual(acl[3][1], 'role:editor')
@@ -179,3 +184,249 @@ class TestACL(NodeTestCase):
         )
         self.assertEqual(principal_roles['otheruser'], ['editor'])
         self.assertEqual(principal_roles['someuser'], ['manager'])
+
+    @testing.transactional
+    def test_prefetch_principal_roles(self):
+        request = self.layer.new_request()
+        session = get_session(request)
+
+        nodes = list()
+        for i in range(3):
+            node = SQLPrincipalACLNode()
+            node.uuid = uuid_module.uuid4()
+            node.principal_roles['user'] = ['editor', 'role_{}'.format(i)]
+            node.principal_roles['group:group'] = ['manager']
+            nodes.append(node)
+        session.commit()
+
+        # resolve roles of multiple nodes in one query
+        node_ids = [node.uuid for node in nodes]
+        result = principal_roles_for(session, node_ids)
+        self.assertEqual(sorted(result.keys()), sorted(node_ids))
+        self.assertEqual(sorted(result[node_ids[1]]['user']), [
+            'editor', 'role_1'
+        ])
+        self.assertEqual(result[node_ids[1]]['group:group'], ['manager'])
+
+        result = principal_roles_for(session, node_ids, ['user', 'other'])
+        self.assertEqual(list(result[node_ids[2]].keys()), ['user'])
+
+        unknown = uuid_module.uuid4()
+        self.assertEqual(principal_roles_for(session, [unknown]), {
+            unknown: {}
+        })
+        self.assertEqual(principal_roles_for(session, []), {})
+
+        # prefetch principal roles for current request
+        request = self.layer.new_request()
+        prefetch_principal_roles(nodes)
+
+        with testing.QueryCounter(session.bind) as counter:
+            for i, node in enumerate(nodes):
+                principal_roles = node.principal_roles
+                self.assertEqual(
+                    sorted(principal_roles.keys()),
+                    ['group:group', 'user']
+                )
+                self.assertEqual(
+                    sorted(principal_roles['user']),
+                    ['editor', 'role_{}'.format(i)]
+                )
+                self.assertEqual(principal_roles['inexistent'], [])
+        self.assertEqual(counter.count, 0)
+
+        # already prefetched nodes are skipped
+        with testing.QueryCounter(session.bind) as counter:
+            prefetch_principal_roles(nodes)
+        self.assertEqual(counter.count, 0)
+
+        # writes keep cache consistent
+        principal_roles = nodes[0].principal_roles
+        principal_roles['user'] = ['viewer']
+        principal_roles['other'] = ['editor', 'editor']
+        del principal_roles['group:group']
+        self.assertEqual(sorted(principal_roles.keys()), ['other', 'user'])
+        self.assertEqual(principal_roles['user'], ['viewer'])
+        self.assertEqual(principal_roles['other'], ['editor'])
+        session.commit()
+
+        request = self.layer.new_request()
+        principal_roles = nodes[0].principal_roles
+        self.assertEqual(sorted(principal_roles.keys()), ['other', 'user'])
+        self.assertEqual(principal_roles['user'], ['viewer'])
+
+    @testing.transactional
+    def test_principal_roles_unique(self):
+        request = self.layer.new_request()
+        session = get_session(request)
+        node = SQLPrincipalACLNode()
+
+        # duplicate roles are ignored
+        node.principal_roles['user'] = ['editor', 'editor']
+        self.assertEqual(session.query(PrincipalRoleRecord).count(), 1)
+
+        # principal roles are unique per node
+        session.add(PrincipalRoleRecord(
+            node_id=node.uuid,
+            principal_id='user',
+            role='editor'
+        ))
+        self.assertRaises(IntegrityError, session.flush)
+        session.rollback()
+
+    @testing.transactional
+    def test_principal_roles_set_based_writes(self):
+        request = self.layer.new_request()
+        session = get_session(request)
+        node = SQLPrincipalACLNode()
+        principal_roles = node.principal_roles
+        principal_roles['user'] = ['editor', 'manager']
+        session.flush()
+
+        # one delete and one insert statement
+        with testing.QueryCounter(session.bind) as counter:
+            principal_roles['user'] = ['manager', 'viewer', 'admin']
+        self.assertEqual(counter.count, 2)
+        self.assertEqual(
+            sorted(principal_roles['user']),
+            ['admin', 'manager', 'viewer']
+        )
+        self.assertEqual(session.query(PrincipalRoleRecord).count(), 3)
+
+        # empty roles only delete
+        with testing.QueryCounter(session.bind) as counter:
+            principal_roles['user'] = []
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(principal_roles['user'], [])
+
+        with testing.QueryCounter(session.bind) as counter:
+            principal_roles['user'] = ['editor']
+            del principal_roles['user']
+        self.assertEqual(counter.count, 3)
+        self.assertEqual(principal_roles['user'], [])
+
+        # dialects without ``ON CONFLICT`` support query existing roles
+        insert_on_conflict = acl.insert_on_conflict
+        acl.insert_on_conflict = {}
+        try:
+            principal_roles['user'] = ['editor', 'manager']
+            principal_roles['user'] = ['manager', 'viewer']
+            with testing.QueryCounter(session.bind) as counter:
+                principal_roles['user'] = ['manager', 'viewer']
+            self.assertEqual(counter.count, 2)
+        finally:
+            acl.insert_on_conflict = insert_on_conflict
+        self.assertEqual(
+            sorted(principal_roles['user']),
+            ['manager', 'viewer']
+        )
+        session.commit()
+
+    @testing.transactional
+    def test_aggregated_roles(self):
+        request = self.layer.new_request()
+        session = get_session(request)
+
+        root = SQLPrincipalACLNode()
+        root.uuid = uuid_module.uuid4()
+        root.principal_roles['user'] = ['viewer']
+        root.principal_roles['other'] = ['viewer']
+        root['folder'] = SQLPrincipalACLNode()
+        folder = root['folder']
+        folder.uuid = uuid_module.uuid4()
+        folder.principal_roles['user'] = ['editor']
+        folder['plain'] = BaseNode()
+        folder['plain']['document'] = SQLPrincipalACLNode()
+        document = folder['plain']['document']
+        document.uuid = uuid_module.uuid4()
+        document.principal_roles['user'] = ['manager']
+        session.commit()
+
+        expected = {
+            'user': {'viewer', 'editor', 'manager'},
+            'other': {'viewer'}
+        }
+        lineage = [document.uuid, folder.uuid, root.uuid]
+
+        # roles of lineage get resolved with one query
+        request = self.layer.new_request()
+        with testing.QueryCounter(session.bind) as counter:
+            self.assertEqual(aggregated_principal_roles(lineage), expected)
+        self.assertEqual(counter.count, 1)
+
+        # roles of nodes are memoized on request
+        with testing.QueryCounter(session.bind) as counter:
+            self.assertEqual(aggregated_principal_roles(lineage), expected)
+            self.assertEqual(
+                aggregated_principal_roles(lineage[1:]),
+                {'user': {'viewer', 'editor'}, 'other': {'viewer'}}
+            )
+            self.assertEqual(document.principal_roles['user'], ['manager'])
+        self.assertEqual(counter.count, 0)
+
+        # aggregated roles on node
+        request = self.layer.new_request()
+        with testing.QueryCounter(session.bind) as counter:
+            self.assertEqual(document.aggregated_roles, expected)
+            self.assertEqual(
+                sorted(document.aggregated_roles_for('user')),
+                ['editor', 'manager', 'viewer']
+            )
+        self.assertEqual(counter.count, 1)
+
+        # ACL with role inheritance
+        document.role_inheritance = True
+        acl = document.__acl__
+        self.assertEqual(
+            sorted([(ace[1], sorted(ace[2])) for ace in acl[:2]]),
+            [('other', []), ('user', ['edit', 'manage'])]
+        )
+
+    @testing.transactional
+    def test_principal_roles_memoized(self):
+        request = self.layer.new_request()
+        session = get_session(request)
+        node = SQLPrincipalACLNode()
+        node.principal_roles['user'] = ['editor']
+        node.principal_roles['group:group'] = ['manager']
+        session.commit()
+
+        # all principal roles of node get loaded with one query
+        request = self.layer.new_request()
+        with testing.QueryCounter(session.bind) as counter:
+            principal_roles = node.principal_roles
+            self.assertEqual(principal_roles['user'], ['editor'])
+            self.assertEqual(principal_roles['user'], ['editor'])
+            self.assertEqual(principal_roles['inexistent'], [])
+            self.assertEqual(
+                principal_roles.keys(),
+                ['group:group', 'user']
+            )
+            self.assertEqual(len(node.__acl__), 4)
+        self.assertEqual(counter.count, 1)
+
+        # writes update memoized principal roles
+        principal_roles['other'] = ['viewer']
+        principal_roles['user'] = ['editor', 'viewer']
+        del principal_roles['group:group']
+        with testing.QueryCounter(session.bind) as counter:
+            self.assertEqual(principal_roles.keys(), ['other', 'user'])
+            self.assertEqual(principal_roles['user'], ['editor', 'viewer'])
+        self.assertEqual(counter.count, 0)
+
+        # roles given as iterator are only consumed once
+        principal_roles['other'] = iter(['editor', 'viewer', 'editor'])
+        self.assertEqual(principal_roles['other'], ['editor', 'viewer'])
+        principal_roles['other'] = (role for role in ['viewer'])
+        self.assertEqual(principal_roles['other'], ['viewer'])
+        principal_roles['empty'] = iter([])
+        self.assertEqual(principal_roles.keys(), ['other', 'user'])
+        session.commit()
+
+        # memoized principal roles are bound to request
+        request = self.layer.new_request()
+        self.assertEqual(principal_roles.keys(), ['other', 'user'])
+        self.assertEqual(
+            sorted(principal_roles['user']),
+            ['editor', 'viewer']
+        )
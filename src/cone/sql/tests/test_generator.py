@@ -0,0 +1,173 @@
+from cone.app.ugm import ugm_backend
+from cone.sql import testing
+from cone.sql.acl import PrincipalRoleRecord
+from cone.sql.generator import PNG_SIGNATURE
+from cone.sql.generator import UgmDataGenerator
+from cone.sql.generator import main
+from cone.sql.ugm import SQLPrincipalBinary
+from cone.sql.ugm import SQLUser
+from cone.sql.ugm import Ugm
+from collections import Counter
+from node.tests import NodeTestCase
+from unittest.mock import Mock
+from unittest.mock import patch
+
+
+class TestGenerator(NodeTestCase):
+    layer = testing.sql_layer
+
+    def test_deterministic(self):
+        def generate(seed):
+            generator = UgmDataGenerator(
+                users=50,
+                groups=10,
+                portraits=0.5,
+                portrait_size=16,
+                acl_nodes=3,
+                seed=seed
+            )
+            return (
+                list(generator.users()),
+                list(generator.groups()),
+                list(generator.memberships()),
+                list(generator.principal_roles())
+            )
+
+        self.assertEqual(generate(1), generate(1))
+        self.assertNotEqual(generate(1), generate(2))
+
+        users, groups, memberships, principal_roles = generate(1)
+        self.assertEqual(len(users), 50)
+        user_id, attrs = users[0]
+        self.assertEqual(user_id, 'user_0000000')
+        self.assertEqual(attrs['fullname'], 'User 0')
+        self.assertEqual(attrs['email'], 'user_0000000@example.com')
+        self.assertEqual(attrs['login'], 'email')
+        portraits = [
+            attrs['portrait'] for _, attrs in users if 'portrait' in attrs
+        ]
+        self.assertTrue(0 < len(portraits) < 50)
+        self.assertTrue(all([len(p) == 16 for p in portraits]))
+        self.assertTrue(all([p.startswith(PNG_SIGNATURE) for p in portraits]))
+        self.assertEqual(groups[0], ('group_00000', {'groupname': 'Group 0'}))
+        self.assertEqual(len(set(memberships)), len(memberships))
+        self.assertEqual(len(principal_roles), 15)
+        self.assertEqual(len(set([r['node_id'] for r in principal_roles])), 3)
+
+    def test_power_law_group_sizes(self):
+        generator = UgmDataGenerator(users=1000, groups=100, alpha=1.5)
+        sizes = Counter([gid for gid, _ in generator.memberships()])
+        self.assertEqual(sizes.most_common(1)[0][0], 'group_00000')
+        self.assertTrue(sizes['group_00000'] > 500)
+        self.assertTrue(sizes['group_00099'] < 20)
+
+    @testing.transactional
+    def test_generate(self):
+        self.layer.new_request()
+
+        ugm = Ugm(
+            name='sql_ugm',
+            parent=None,
+            user_attrs=['fullname', 'email', 'portrait'],
+            group_attrs=['groupname'],
+            binary_attrs=['portrait'],
+            log_auth=False,
+            user_expires_attr=None
+        )
+        generator = UgmDataGenerator(
+            users=20,
+            groups=5,
+            portraits=0.5,
+            portrait_size=64,
+            acl_nodes=4,
+            acl_principals=3
+        )
+        generator(ugm, batch_size=7)
+
+        session = ugm.session
+        self.assertEqual(len(ugm.users), 20)
+        self.assertEqual(len(ugm.groups), 5)
+        self.assertEqual(
+            ugm.users.id_for_login('user_0000003@example.com'),
+            'user_0000003'
+        )
+        self.assertEqual(
+            session.query(SQLPrincipalBinary).count(),
+            len([1 for _, attrs in generator.users() if 'portrait' in attrs])
+        )
+        member_count = sum([
+            len(ugm.groups[gid].member_ids) for gid in ugm.groups.keys()
+        ])
+        self.assertEqual(member_count, len(list(generator.memberships())))
+        self.assertEqual(session.query(PrincipalRoleRecord).count(), 12)
+        session.commit()
+
+    @testing.transactional
+    def test_portrait_attr(self):
+        self.layer.new_request()
+
+        ugm = Ugm(
+            name='sql_ugm',
+            parent=None,
+            user_attrs=['fullname', 'email'],
+            group_attrs=['groupname'],
+            binary_attrs=[],
+            log_auth=False,
+            user_expires_attr=None
+        )
+        generator = UgmDataGenerator(users=5, groups=1, portraits=0.5)
+        with self.assertRaises(ValueError) as arc:
+            generator(ugm)
+        self.assertEqual(
+            str(arc.exception),
+            'Portrait attribute "portrait" is no binary attribute'
+        )
+
+        # no portraits, no binary attribute needed
+        generator = UgmDataGenerator(users=5, groups=1, portraits=0)
+        generator(ugm)
+        self.assertEqual(len(ugm.users), 5)
+
+    @testing.transactional
+    def test_main(self):
+        request = self.layer.new_request()
+        session = self.layer.sql_session
+        ugm = Ugm(
+            name='sql_ugm',
+            parent=None,
+            user_attrs=['fullname', 'email', 'avatar'],
+            group_attrs=['groupname'],
+            binary_attrs=['avatar'],
+            log_auth=False,
+            user_expires_attr=None
+        )
+        env = dict(request=request, closer=Mock())
+
+        close = Mock()
+
+        def run(*argv):
+            with patch('pyramid.paster.bootstrap', return_value=env), \
+                    patch('cone.sql.session_factory', return_value=session), \
+                    patch.object(session, 'close', close), \
+                    patch.object(ugm_backend, 'ugm', ugm):
+                main(['app.ini#app'] + list(argv))
+
+        run(
+            '--users', '10',
+            '--groups', '2',
+            '--portraits', '0.5',
+            '--portrait-attr', 'avatar',
+            '--portrait-size', '16'
+        )
+        self.assertEqual(len(ugm.users), 10)
+        self.assertEqual(len(ugm.groups), 2)
+        self.assertTrue(session.query(SQLPrincipalBinary).count() > 0)
+        self.assertEqual(close.call_count, 1)
+        self.assertEqual(env['closer'].call_count, 1)
+
+        # session and environment get closed on failure
+        with self.assertRaises(ValueError):
+            run('--users', '10', '--portrait-attr', 'portrait')
+        self.assertEqual(session.query(SQLUser).count(), 10)
+        self.assertEqual(close.call_count, 2)
+        self.assertEqual(env['closer'].call_count, 2)
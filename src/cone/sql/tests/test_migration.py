@@ -0,0 +1,127 @@
+from cone.sql import testing
+from cone.sql.acl import PrincipalRoleRecord
+from cone.sql.migration import create_indexes
+from cone.sql.migration import migrate_binary_attrs
+from cone.sql.migration import migrate_principal_roles
+from cone.sql.migration import rebuild_user_logins
+from cone.sql.ugm import SQLGroup
+from cone.sql.ugm import SQLPrincipalBinary
+from cone.sql.ugm import SQLUser
+from cone.sql.ugm import SQLUserLogin
+from node.tests import NodeTestCase
+from sqlalchemy import inspect
+import base64
+import uuid
+
+
+class TestMigration(NodeTestCase):
+    layer = testing.sql_layer
+
+    @testing.transactional
+    def test_create_indexes(self):
+        # DDL on connection of transactional session gets rolled back
+        connection = self.layer.sql_session.bind
+
+        def index_names():
+            return [
+                index['name'] for index in
+                inspect(connection).get_indexes('user_login')
+            ]
+
+        index = SQLUserLogin.__table__.indexes.copy().pop()
+        index.drop(connection)
+        self.assertEqual(index_names(), [])
+
+        create_indexes(connection)
+        self.assertEqual(index_names(), ['ix_user_login_login'])
+
+        # existing indexes are skipped
+        create_indexes(connection)
+        self.assertEqual(index_names(), ['ix_user_login_login'])
+
+    @testing.transactional
+    def test_rebuild_user_logins(self):
+        session = self.layer.sql_session
+        session.add(SQLUser(id='max', login='mail', data={
+            'mail': 'max@example.com'
+        }))
+        session.add(SQLUser(id='moritz', data={'mail': 'moritz@example.com'}))
+        session.flush()
+
+        # simulate database created before ``user_login`` table existed
+        session.query(SQLUserLogin).delete()
+        self.assertEqual(session.query(SQLUserLogin).count(), 0)
+
+        rebuild_user_logins(session)
+        self.assertEqual(
+            [rec.login for rec in session.query(SQLUserLogin)],
+            ['max@example.com']
+        )
+        session.commit()
+
+    @testing.transactional
+    def test_migrate_binary_attrs(self):
+        session = self.layer.sql_session
+        # simulate principals created before ``principal_binary`` existed
+        session.add(SQLUser(id='max', data={
+            'mail': 'max@example.com',
+            'portrait': base64.b64encode(b'\x89PNG').decode()
+        }))
+        session.add(SQLUser(id='moritz', data={'portrait': ''}))
+        session.add(SQLGroup(id='group', data={'title': 'Group'}))
+        session.flush()
+        session.expunge_all()
+
+        # user and group columns get loaded along with principals
+        with testing.QueryCounter(session.bind) as counter:
+            migrate_binary_attrs(session, ['portrait'])
+        self.assertFalse(any([
+            statement.startswith('SELECT user.')
+            for statement in counter.statements
+        ]))
+        max = session.query(SQLUser).filter(SQLUser.id == 'max').one()
+        self.assertEqual(max.data, {'mail': 'max@example.com'})
+        self.assertEqual(max.binaries['portrait'].value, b'\x89PNG')
+        moritz = session.query(SQLUser).filter(SQLUser.id == 'moritz').one()
+        self.assertEqual(moritz.data, {})
+        self.assertEqual(session.query(SQLPrincipalBinary).count(), 1)
+        session.commit()
+
+    @testing.transactional
+    def test_migrate_principal_roles(self):
+        session = self.layer.sql_session
+        # DDL on connection of transactional session gets rolled back
+        connection = session.bind
+
+        # simulate database created before unique index existed
+        table = PrincipalRoleRecord.__table__
+        for index in table.indexes:
+            index.drop(connection)
+
+        node_id = uuid.uuid4()
+        for role in ['editor', 'editor', 'editor', 'manager']:
+            session.add(PrincipalRoleRecord(
+                node_id=node_id,
+                principal_id='user',
+                role=role
+            ))
+        session.add(PrincipalRoleRecord(
+            node_id=node_id,
+            principal_id='other',
+            role='editor'
+        ))
+        session.flush()
+        self.assertEqual(session.query(PrincipalRoleRecord).count(), 5)
+
+        migrate_principal_roles(connection)
+        self.assertEqual(sorted([
+            (rec.principal_id, rec.role) for rec in
+            session.query(PrincipalRoleRecord)
+        ]), [('other', 'editor'), ('user', 'editor'), ('user', 'manager')])
+        self.assertEqual(sorted([
+            index['name'] for index in
+            inspect(connection).get_indexes('principal_roles')
+        ]), [
+            'ix_principal_roles_node_id_principal_id_role',
+            'ix_principal_roles_principal_id'
+        ])
@@ -4,20 +4,32 @@ from cone.sql import get_session
 from cone.sql import SQLBase
 from cone.sql import testing
 from cone.sql import use_tm
+from cone.sql import model
 from cone.sql.model import GUID
 from cone.sql.model import SQLRowNode
+from cone.sql.model import SQLTableResult
 from cone.sql.model import SQLTableNode
 from cone.sql.model import UNICODE_TYPE
+from cone.sql.model import new_guid
+from cone.sql.model import set_guid_factory
+from cone.sql.model import uuid7
+from datetime import datetime
+from datetime import timedelta
 from node.tests import NodeTestCase
 from sqlalchemy import Column
+from sqlalchemy import DateTime
 from sqlalchemy import Integer
 from sqlalchemy import String
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects import sqlite
 from sqlalchemy.dialects.postgresql.base import UUID
 from sqlalchemy.engine import default
 from sqlalchemy.orm.session import Session
 from sqlalchemy.orm.unitofwork import UOWTransaction
+from sqlalchemy.sql.sqltypes import BINARY
 from sqlalchemy.sql.sqltypes import CHAR
 import os
+import time
 import uuid
 
 
@@ -52,6 +64,14 @@ class UUIDAsKeyContainer(SQLTableNode):
     child_factory = UUIDAsKeyNode
 
 
+class BinaryUUIDAsPrimaryKeyRecord(SQLBase):
+    """Record with binary stored UUID as primary key.
+    """
+    __tablename__ = 'binary_uuid_as_primary_key'
+    uid_key = Column(GUID(binary=True), primary_key=True)
+    field = Column(String)
+
+
 class StringAsPrimaryKeyRecord(SQLBase):
     """Record with string as primary key.
     """
@@ -86,6 +106,25 @@ class IntegerAsKeyContainer(SQLTableNode):
     child_factory = IntegerAsKeyNode
 
 
+class SortableRecord(SQLBase):
+    """Record with sortable columns.
+    """
+    __tablename__ = 'sortable'
+    integer_key = Column(Integer, primary_key=True)
+    title = Column(String, index=True)
+    rank = Column(Integer, index=True)
+    created = Column(DateTime, index=True)
+
+
+class SortableNode(SQLRowNode):
+    record_class = SortableRecord
+
+
+class SortableContainer(SQLTableNode):
+    record_class = SortableRecord
+    child_factory = SortableNode
+
+
 class TestModel(NodeTestCase):
     layer = testing.sql_layer
 
@@ -140,6 +179,116 @@ class TestModel(NodeTestCase):
             uuid.UUID('d8f1d964-9f2f-4df5-9f30-c5a90052576d')
         )
 
+        # Binary storage
+        guid = GUID(binary=True)
+        self.assertTrue(guid.binary)
+        self.assertFalse(GUID.binary)
+
+        dialect.name = 'postgresql'
+        res = guid.load_dialect_impl(dialect)
+        self.assertTrue(isinstance(res, UUID))
+        self.assertEqual(
+            guid.process_bind_param(value, dialect),
+            'd8f1d964-9f2f-4df5-9f30-c5a90052576d'
+        )
+        self.assertEqual(
+            guid.process_result_value(value, dialect),
+            uuid.UUID('d8f1d964-9f2f-4df5-9f30-c5a90052576d')
+        )
+
+        dialect.name = 'other'
+        res = guid.load_dialect_impl(dialect)
+        self.assertTrue(isinstance(res, BINARY))
+        self.assertEqual(res.length, 16)
+
+        value = uuid.UUID('d8f1d964-9f2f-4df5-9f30-c5a90052576d')
+        self.assertEqual(guid.process_bind_param(value, dialect), value.bytes)
+        self.assertEqual(
+            guid.process_bind_param(str(value), dialect),
+            value.bytes
+        )
+        self.assertEqual(guid.process_bind_param(None, dialect), None)
+        self.assertEqual(
+            guid.process_result_value(value.bytes, dialect),
+            value
+        )
+        self.assertEqual(guid.process_result_value(None, dialect), None)
+
+    def test_GUID_result_processor(self):
+        value = uuid.UUID('d8f1d964-9f2f-4df5-9f30-c5a90052576d')
+
+        # result processor is built per dialect
+        dialect = sqlite.dialect()
+        process = GUID().dialect_impl(dialect).result_processor(dialect, None)
+        self.assertEqual(process(None), None)
+        self.assertEqual(process(value.hex), value)
+        self.assertEqual(process(str(value)), value)
+
+        process = GUID(binary=True)\
+            .dialect_impl(dialect)\
+            .result_processor(dialect, None)
+        self.assertEqual(process(None), None)
+        self.assertEqual(process(value.bytes), value)
+        self.assertEqual(process(memoryview(value.bytes)), value)
+
+        # postgresql drivers mostly return ``uuid.UUID`` objects which are
+        # passed through
+        dialect = postgresql.psycopg.dialect()
+        process = GUID().dialect_impl(dialect).result_processor(dialect, None)
+        self.assertEqual(process(None), None)
+        self.assertTrue(process(value) is value)
+        self.assertEqual(process(str(value)), value)
+
+    def test_uuid7(self):
+        before = time.time_ns() // 1000000
+        value = uuid7()
+        after = time.time_ns() // 1000000
+        self.assertIsInstance(value, uuid.UUID)
+        self.assertEqual(value.version, 7)
+        self.assertEqual(value.variant, uuid.RFC_4122)
+        timestamp = value.int >> 80
+        self.assertTrue(before <= timestamp <= after)
+
+        # UUID's created in different milliseconds are ordered
+        values = list()
+        for i in range(3):
+            values.append(uuid7())
+            time.sleep(0.002)
+        self.assertEqual(sorted(values), values)
+        self.assertEqual(len(set(uuid7() for i in range(1000))), 1000)
+
+    def test_guid_factory(self):
+        self.assertEqual(new_guid().version, 4)
+        try:
+            set_guid_factory('uuid7')
+            self.assertEqual(new_guid().version, 7)
+            set_guid_factory('uuid4')
+            self.assertEqual(new_guid().version, 4)
+            err = self.expectError(ValueError, set_guid_factory, 'inexistent')
+            self.assertEqual(str(err), 'Unknown GUID factory: inexistent')
+        finally:
+            model.guid_factory = uuid.uuid4
+
+    def test_GUID_binary_storage(self):
+        request = self.layer.new_request()
+        session = get_session(request)
+        uid = uuid.UUID('4c2c0ff1-9f1e-4f4e-8c8b-8a1d2b0f7a13')
+        session.add(BinaryUUIDAsPrimaryKeyRecord(uid_key=uid, field='Value'))
+        session.commit()
+
+        session.expunge_all()
+        rec = session.get(BinaryUUIDAsPrimaryKeyRecord, uid)
+        self.assertEqual(rec.uid_key, uid)
+        self.assertEqual(rec.field, 'Value')
+
+        raw = session.connection().exec_driver_sql(
+            'SELECT uid_key FROM binary_uuid_as_primary_key'
+        ).scalar()
+        self.assertEqual(raw, uid.bytes)
+
+        session.delete(rec)
+        session.commit()
+
     @reset_entry_registry
     def test_UUID_as_primary_key(self):
         # Resgister entry
@@ -447,6 +596,251 @@ class TestModel(NodeTestCase):
 
         self.assertEqual(list(iter(child)), [])
 
+    @reset_entry_registry
+    @testing.transactional
+    def test_page(self):
+        register_entry('sortable_container', SortableContainer)
+        self.layer.new_request()
+        container = get_root()['sortable_container']
+        session = container.session
+        created = datetime(2026, 1, 1)
+        for i in range(10):
+            session.add(SortableRecord(
+                integer_key=i,
+                title='Title {}'.format(9 - i),
+                rank=i % 3,
+                created=created + timedelta(days=i % 4)
+            ))
+        session.flush()
+
+        def page_through(sort, size):
+            pages = list()
+            token = None
+            while True:
+                nodes, token = container.page(
+                    sort=sort,
+                    after=token,
+                    size=size
+                )
+                pages.append([node.name for node in nodes])
+                if token is None:
+                    return pages
+
+        # primary key order by default
+        nodes, token = container.page(size=4)
+        self.assertTrue(isinstance(nodes[0], SortableNode))
+        self.assertEqual(nodes[0].attrs['title'], 'Title 9')
+        self.assertEqual(page_through(None, 4), [
+            ['0', '1', '2', '3'], ['4', '5', '6', '7'], ['8', '9']
+        ])
+
+        # last page is full
+        self.assertEqual(page_through(None, 5), [
+            ['0', '1', '2', '3', '4'], ['5', '6', '7', '8', '9']
+        ])
+
+        self.assertEqual(page_through('title', 4), [
+            ['9', '8', '7', '6'], ['5', '4', '3', '2'], ['1', '0']
+        ])
+
+        # mixed sort directions and duplicate values, primary key is used as
+        # tie breaker
+        self.assertEqual(page_through(['-rank', 'title'], 3), [
+            ['8', '5', '2'], ['7', '4', '1'], ['9', '6', '3'], ['0']
+        ])
+        self.assertEqual(page_through(['created', '-integer_key'], 4), [
+            ['8', '4', '0', '9'], ['5', '1', '6', '2'], ['7', '3']
+        ])
+
+        # token is bound to sort
+        nodes, token = container.page(sort=['title'], size=4)
+        err = self.expectError(
+            ValueError,
+            container.page,
+            sort=['rank'],
+            after=token
+        )
+        self.assertEqual(str(err), 'Continuation token does not match sort')
+
+        err = self.expectError(ValueError, container.page, after='invalid')
+        self.assertEqual(str(err), 'Invalid continuation token')
+
+        err = self.expectError(ValueError, container.page, sort=['inexistent'])
+        self.assertEqual(str(err), 'Unknown sort column: inexistent')
+
+    @reset_entry_registry
+    @testing.transactional
+    def test_filter(self):
+        register_entry('sortable_container', SortableContainer)
+        self.layer.new_request()
+        container = get_root()['sortable_container']
+        session = container.session
+        for i in range(10):
+            session.add(SortableRecord(
+                integer_key=i,
+                title='Title {}'.format(9 - i),
+                rank=i % 3
+            ))
+        session.flush()
+
+        # results are lazy
+        with testing.QueryCounter(session.bind) as counter:
+            result = container.filter(rank=1)
+            result = result.order_by('-integer_key')[1:]
+        self.assertEqual(counter.count, 0)
+        self.assertTrue(isinstance(result, SQLTableResult))
+
+        with testing.QueryCounter(session.bind) as counter:
+            nodes = list(result)
+        self.assertEqual(counter.count, 1)
+        self.assertTrue(isinstance(nodes[0], SortableNode))
+        self.assertEqual([node.name for node in nodes], ['4', '1'])
+
+        def keys(result):
+            return result.order_by('integer_key').keys()
+
+        self.assertEqual(keys(container.filter(rank__ne=1)), [
+            '0', '2', '3', '5', '6', '8', '9'
+        ])
+        self.assertEqual(keys(container.filter(rank__gt=1)), ['2', '5', '8'])
+        self.assertEqual(
+            keys(container.filter(integer_key__ge=3, integer_key__lt=5)),
+            ['3', '4']
+        )
+        self.assertEqual(
+            keys(container.filter(integer_key__le=1)),
+            ['0', '1']
+        )
+        self.assertEqual(
+            keys(container.filter(title__in=['Title 1', 'Title 2'])),
+            ['7', '8']
+        )
+        self.assertEqual(keys(container.filter(title__like='%e 9')), ['0'])
+        self.assertEqual(keys(container.filter(title__ilike='title 8')), ['1'])
+        self.assertEqual(keys(container.filter()), [str(i) for i in range(10)])
+
+        # arbitrary SQLAlchemy clauses
+        result = container.query(SortableRecord.rank == 0)
+        self.assertEqual(keys(result), ['0', '3', '6', '9'])
+
+        # count, indexing and slicing
+        result = container.filter(rank=0).order_by('title')
+        self.assertEqual(result.count(), 4)
+        self.assertEqual(result[0].name, '9')
+        self.assertEqual(result[3].name, '0')
+        self.assertEqual(result.first().name, '9')
+        self.assertEqual(result[1:3].keys(), ['6', '3'])
+        self.assertEqual(result[:2].keys(), ['9', '6'])
+        self.assertEqual(result[2:].keys(), ['3', '0'])
+        self.assertEqual(result[2:].count(), 2)
+        self.expectError(IndexError, result.__getitem__, 4)
+        self.expectError(IndexError, result.__getitem__, -1)
+        self.expectError(ValueError, result.__getitem__, slice(0, 4, 2))
+        self.assertIsNone(container.filter(rank=5).first())
+
+        # slicing sliced results
+        self.assertEqual(result[1:3][1:].keys(), ['3'])
+        self.assertEqual(result[1:3][:5].keys(), ['6', '3'])
+        self.assertEqual(result[1:3].count(), 2)
+        self.assertEqual(result[1:3][1].name, '3')
+        self.expectError(IndexError, result[1:3].__getitem__, 2)
+        self.assertEqual(result[3:1].keys(), [])
+        self.assertIsNone(result[4:].first())
+
+        # ordering sliced results orders before slicing
+        sliced = container.filter(rank=0)[1:3]
+        self.assertEqual(sliced.order_by('-integer_key').keys(), ['6', '3'])
+        self.assertEqual(sliced.order_by('title').keys(), ['6', '3'])
+        self.assertEqual(sliced.order_by('integer_key').keys(), ['3', '6'])
+
+        err = self.expectError(ValueError, container.filter, inexistent=1)
+        self.assertEqual(str(err), 'Unknown filter column: inexistent')
+        err = self.expectError(ValueError, container.filter, rank__foo=1)
+        self.assertEqual(str(err), 'Unknown filter operator: foo')
+
+    @reset_entry_registry
+    @testing.transactional
+    def test_bulk_operations(self):
+        register_entry('sortable_container', SortableContainer)
+        self.layer.new_request()
+        container = get_root()['sortable_container']
+        session = container.session
+        for i in range(10):
+            session.add(SortableRecord(
+                integer_key=i,
+                title='Title {}'.format(i),
+                rank=i % 3
+            ))
+        session.flush()
+        record = session.get(SortableRecord, 1)
+
+        # one statement per batch
+        with testing.QueryCounter(session.bind) as counter:
+            count = container.delete_many(['0', '1', '2', '42'], batch_size=2)
+        self.assertEqual(count, 3)
+        self.assertEqual(counter.count, 2)
+        self.assertEqual(container.delete_many([]), 0)
+        self.assertEqual(
+            sorted(container.keys(), key=int),
+            ['3', '4', '5', '6', '7', '8', '9']
+        )
+        # deleted records are removed from session
+        self.assertFalse(record in session)
+
+        err = self.expectError(KeyError, container.delete_many, ['a'])
+        self.assertTrue(str(err).startswith('"Failed to convert node name'))
+
+        record = session.get(SortableRecord, 4)
+        with testing.QueryCounter(session.bind) as counter:
+            count = container.update_where(
+                {'rank__in': [0, 1]},
+                {'title': 'Updated'}
+            )
+        self.assertEqual(count, 5)
+        self.assertEqual(counter.count, 1)
+        # loaded records are synchronized
+        self.assertEqual(record.title, 'Updated')
+        self.assertEqual(
+            container.filter(title='Updated').order_by('integer_key').keys(),
+            ['3', '4', '6', '7', '9']
+        )
+
+        err = self.expectError(
+            ValueError,
+            container.update_where,
+            {'rank': 0},
+            {'inexistent': 1}
+        )
+        self.assertEqual(str(err), 'Unknown update column: inexistent')
+
+        with testing.QueryCounter(session.bind) as counter:
+            count = container.delete_where({'title': 'Updated'})
+        self.assertEqual(count, 5)
+        self.assertEqual(counter.count, 1)
+        self.assertFalse(record in session)
+        self.assertEqual(sorted(container.keys(), key=int), ['5', '8'])
+
+        # fetch strategy selects affected primary keys first
+        count = container.delete_where(
+            {'integer_key__gt': 6},
+            synchronize_session='fetch'
+        )
+        self.assertEqual(count, 1)
+        self.assertEqual(container.keys(), ['5'])
+
+        # empty criteria require ``all`` to affect all children
+        err = self.expectError(ValueError, container.delete_where, {})
+        self.assertEqual(
+            str(err),
+            'Empty criteria, pass ``all=True`` to affect all children'
+        )
+        self.expectError(ValueError, container.update_where, {}, {'rank': 1})
+        self.assertEqual(container.keys(), ['5'])
+        self.assertEqual(container.update_where({}, {'rank': 1}, all=True), 1)
+        self.assertEqual(container['5'].record.rank, 1)
+        self.assertEqual(container.delete_where({}, all=True), 1)
+        self.assertEqual(container.keys(), [])
+
     @reset_entry_registry
     @testing.delete_table_records(IntegerAsPrimaryKeyRecord)
     def test_use_tm(self):
@@ -1,9 +1,14 @@
 from cone import sql
 from cone.app import RemoteAddrFilter
 from cone.sql import testing
+from cone.sql.ugm import SQLUser
 from node.tests import NodeTestCase
 from pyramid.paster import get_app
+from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import update
 from sqlalchemy.orm.session import Session
+from unittest.mock import patch
 import os
 import shutil
 import tempfile
@@ -88,3 +93,216 @@ class TestSQL(NodeTestCase):
 
         # SQL session has been hooked up to environment
         self.assertTrue(isinstance(environ[sql.session_key], Session))
+
+    @temp_directory
+    def test_database_template(self, tempdir):
+        seeded = []
+
+        def seed(session):
+            seeded.append(session)
+            session.add(SQLUser(id='max'))
+
+        url = 'sqlite:///{}/template.db'.format(tempdir)
+        template = testing.database_template(url, seed=seed)
+        self.assertIs(testing.database_template(url, seed=seed), template)
+        self.assertFalse(template.created)
+
+        # template gets created and seeded once
+        urls = [template.clone('test_1.db'), template.clone('test_2.db')]
+        self.assertTrue(template.created)
+        self.assertEqual(len(seeded), 1)
+        self.assertEqual([url.database for url in urls], [
+            os.path.join(tempdir, 'test_1.db'),
+            os.path.join(tempdir, 'test_2.db')
+        ])
+
+        # clones are independent databases containing the seed data
+        engine = create_engine(urls[0])
+        with Session(engine) as session:
+            session.add(SQLUser(id='moritz'))
+            session.commit()
+        engine.dispose()
+        for url, ids in zip(urls, [['max', 'moritz'], ['max']]):
+            engine = create_engine(url)
+            with Session(engine) as session:
+                self.assertEqual(
+                    sorted([user.id for user in session.query(SQLUser)]),
+                    ids
+                )
+            engine.dispose()
+
+    def test_transactional(self):
+        layer_session = self.layer.sql_session
+
+        @testing.transactional
+        def test(inst):
+            session = inst.layer.sql_session
+            self.assertIsNot(session, layer_session)
+            session.add(SQLUser(id='max'))
+            session.commit()
+            self.assertEqual(session.query(SQLUser).count(), 1)
+            session.add(SQLUser(id='moritz'))
+            session.rollback()
+            self.assertEqual(session.query(SQLUser).count(), 1)
+
+        test(self)
+        # changes of test are rolled back and layer session is restored
+        self.assertIs(self.layer.sql_session, layer_session)
+        self.assertEqual(layer_session.query(SQLUser).count(), 0)
+        layer_session.commit()
+
+    def test_worker_db_name(self):
+        with patch.dict(os.environ, clear=False) as environ:
+            environ.pop('CONE_SQL_TEST_WORKER', None)
+            environ.pop('PYTEST_XDIST_WORKER', None)
+            self.assertIsNone(testing.get_worker_id())
+            self.assertEqual(testing.worker_db_name('ugm'), 'ugm')
+
+            environ['PYTEST_XDIST_WORKER'] = 'gw1'
+            self.assertEqual(testing.get_worker_id(), 'gw1')
+            self.assertEqual(testing.worker_db_name('ugm'), 'ugm_gw1')
+            self.assertEqual(
+                testing.worker_db_name('test.db'),
+                'test_gw1.db'
+            )
+
+            environ['CONE_SQL_TEST_WORKER'] = '3'
+            self.assertEqual(testing.get_worker_id(), '3')
+            self.assertEqual(testing.worker_db_name('ugm'), 'ugm_3')
+
+    @testing.transactional
+    def test_persist_session(self):
+        session = self.layer.sql_session
+        commits = list()
+        event.listen(session, 'after_commit', commits.append)
+
+        # change tracking listeners are registered per session
+        track_flush = sql._track_flush
+        self.assertTrue(event.contains(session, 'after_flush', track_flush))
+        self.assertFalse(event.contains(Session, 'after_flush', track_flush))
+        # sessions without change tracking are always considered changed
+        self.assertTrue(sql.has_changes(Session()))
+
+        # nothing changed, no flush and no commit
+        self.assertFalse(sql.has_changes(session))
+        with testing.QueryCounter(session.bind) as counter:
+            sql.persist_session(session)
+        self.assertEqual(counter.count, 0)
+        self.assertEqual(commits, [])
+
+        # pending records get committed
+        session.add(SQLUser(id='max'))
+        self.assertTrue(sql.has_changes(session))
+        sql.persist_session(session)
+        self.assertEqual(len(commits), 1)
+        self.assertFalse(sql.has_changes(session))
+
+        # unchanged loaded records
+        user = session.query(SQLUser).one()
+        user.id = 'max'
+        self.assertFalse(sql.has_changes(session))
+
+        # changes already flushed in current transaction
+        user.id = 'moritz'
+        session.flush()
+        self.assertFalse(session.dirty)
+        self.assertTrue(sql.has_changes(session))
+        sql.persist_session(session)
+        self.assertEqual(len(commits), 2)
+
+        # bulk statements executed via session
+        session.execute(update(SQLUser).values(login='mail'))
+        self.assertTrue(sql.has_changes(session))
+        sql.persist_session(session)
+        self.assertEqual(len(commits), 3)
+
+        # rollback resets changes
+        session.execute(update(SQLUser).values(login=None))
+        session.rollback()
+        self.assertFalse(sql.has_changes(session))
+
+        # deferred commit only flushes
+        sql.defer_commit(session)
+        user.id = 'max'
+        sql.persist_session(session)
+        self.assertEqual(len(commits), 3)
+        self.assertTrue(sql.has_changes(session))
+        sql.defer_commit(session, False)
+
+    def test_defer_commit(self):
+        commits = list()
+        started = list()
+
+        class DummySession(object):
+            fail = False
+
+            def __init__(self):
+                self.info = dict()
+                self.new = [object()]
+                self.dirty = self.deleted = []
+
+            def commit(self):
+                if self.fail:
+                    raise ValueError('Commit failed')
+                commits.append(self)
+
+            def close(self):
+                pass
+
+        status = ['200 OK']
+        closed = list()
+
+        def app(environ, start_response):
+            start_response(status[0], [])
+            return [b'']
+
+        def lazy_app(environ, start_response):
+            # ``start_response`` is called on first iteration
+            start_response(status[0], [])
+            yield b''
+
+        def start_response(status, headers, exc_info=None):
+            started.append(status)
+
+        def session_factory():
+            session = DummySession()
+            session.close = lambda: closed.append(session)
+            sql.defer_commit(session)
+            return session
+
+        def request(app):
+            result = sql.WSGISQLSession(app)({}, start_response)
+            try:
+                return list(result)
+            finally:
+                result.close()
+
+        with patch.object(sql, 'session_factory', session_factory), \
+                patch.object(sql, 'register', lambda session: None):
+            self.assertEqual(request(app), [b''])
+            self.assertEqual(len(commits), 1)
+            self.assertEqual(len(closed), 1)
+
+            # changes are committed before the response gets started
+            self.assertEqual(request(lazy_app), [b''])
+            self.assertEqual(len(commits), 2)
+            self.assertEqual(len(closed), 2)
+            self.assertEqual(started, ['200 OK', '200 OK'])
+
+            # no commit on error response
+            status[0] = '500 Internal Server Error'
+            request(app)
+            request(lazy_app)
+            self.assertEqual(len(commits), 2)
+            self.assertEqual(len(closed), 4)
+
+            # failing commit prevents the response from being started
+            status[0] = '200 OK'
+            DummySession.fail = True
+            with self.assertRaises(ValueError):
+                request(app)
+            with self.assertRaises(ValueError):
+                request(lazy_app)
+            self.assertEqual(len(commits), 2)
+            self.assertEqual(len(closed), 6)
+            self.assertEqual(len(started), 4)
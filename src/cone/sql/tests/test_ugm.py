@@ -1,18 +1,30 @@
+from cone.sql import has_changes
 from cone.sql import testing
+from cone.sql.migration import rebuild_user_logins
 from cone.sql.ugm import Base
 from cone.sql.ugm import Group
 from cone.sql.ugm import SQLGroup
 from cone.sql.ugm import SQLGroupAssignment
-from cone.sql.ugm import SQLPrincipal
+from cone.sql.ugm import SQLPrincipalBinary
 from cone.sql.ugm import SQLUser
+from cone.sql.ugm import SQLUserLogin
 from cone.sql.ugm import Ugm
 from cone.sql.ugm import User
+from cone.sql.ugm import jsonb_set_statement
+from cone.sql.ugm import schema_attrs_for
+from cone.sql.ugm import login_cache
+from cone.sql.ugm import login_changes_key
 from datetime import datetime
 from datetime import timedelta
 from node.tests import NodeTestCase
+from node.utils import UNSET
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.engine import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.attributes import flag_modified
+from unittest.mock import Mock
+from unittest.mock import patch
+import base64
 import os
 import shutil
 import tempfile
@@ -89,10 +101,7 @@ class TestSqlModel(unittest.TestCase):
 class TestSqlUgm(NodeTestCase):
     layer = testing.sql_layer
 
-    @testing.delete_table_records(SQLPrincipal)
-    @testing.delete_table_records(SQLGroup)
-    @testing.delete_table_records(SQLGroupAssignment)
-    @testing.delete_table_records(SQLUser)
+    @testing.transactional
     def test_ugm(self):
         os.environ['CONE_SQL_USE_TM'] = '0'
         self.layer.new_request()
@@ -428,3 +437,674 @@ class TestSqlUgm(NodeTestCase):
             sorted(users['donald'].attrs.keys()),
             ['address', 'phone']
         )
+
+    @testing.transactional
+    def test_search_projection(self):
+        self.layer.new_request()
+
+        ugm = Ugm(
+            name='sql_ugm',
+            parent=None,
+            user_attrs=['mail', 'portrait'],
+            group_attrs=['title'],
+            binary_attrs=['portrait'],
+            log_auth=False,
+            user_expires_attr=None
+        )
+        users = ugm.users
+        groups = ugm.groups
+
+        users.create('max', mail='max@example.com', portrait=b'\x89PNG')
+        users.create('moritz', mail='moritz@example.com', login='mail')
+        groups.create('group', title='Group')
+
+        # only requested attributes are projected, binary attributes get
+        # decoded and inexistent JSON keys result in None
+        res = users.search(attrlist=['mail', 'portrait', 'login'])
+        self.assertEqual(sorted(res), [
+            ('max', {
+                'login': None,
+                'mail': 'max@example.com',
+                'portrait': b'\x89PNG'
+            }),
+            ('moritz', {
+                'login': 'mail',
+                'mail': 'moritz@example.com',
+                'portrait': None
+            })
+        ])
+
+        # criteria and projection combined
+        res = users.search(
+            criteria=dict(mail='moritz*'),
+            attrlist=['mail']
+        )
+        self.assertEqual(res, [('moritz', {'mail': 'moritz@example.com'})])
+
+        # empty attrlist returns all attributes except binary ones
+        res = users.search(criteria=dict(id='max'), attrlist=[])
+        self.assertEqual(res, [('max', {
+            'login': None,
+            'mail': 'max@example.com'
+        })])
+
+        # groups have no login column, value gets read from JSON data
+        res = groups.search(attrlist=['title', 'login'])
+        self.assertEqual(res, [('group', {'login': None, 'title': 'Group'})])
+
+        res = groups.search(attrlist=[])
+        self.assertEqual(res, [('group', {'login': None, 'title': 'Group'})])
+
+        ugm.session.commit()
+
+    @testing.transactional
+    def test_binary_attrs(self):
+        self.layer.new_request()
+
+        ugm = Ugm(
+            name='sql_ugm',
+            parent=None,
+            user_attrs=['mail', 'portrait', 'signature'],
+            group_attrs=[],
+            binary_attrs=['portrait', 'signature'],
+            log_auth=False,
+            user_expires_attr=None
+        )
+        users = ugm.users
+        session = ugm.session
+
+        # binary attributes are stored unencoded in separate table
+        max = users.create('max', mail='max@example.com', portrait=b'\x89PNG')
+        session.flush()
+        self.assertEqual(max.record.data, {'mail': 'max@example.com'})
+        binary = session.query(SQLPrincipalBinary).one()
+        self.assertEqual(binary.principal_guid, max.record.guid)
+        self.assertEqual(binary.name, 'portrait')
+        self.assertEqual(binary.value, b'\x89PNG')
+        self.assertEqual(max.attrs['portrait'], b'\x89PNG')
+
+        # binary attributes are loaded on demand
+        session.expunge_all()
+        max = users['max']
+        self.assertFalse('binaries' in max.record.__dict__)
+        self.assertEqual(max.attrs['mail'], 'max@example.com')
+        self.assertFalse('binaries' in max.record.__dict__)
+        self.assertEqual(max.attrs['portrait'], b'\x89PNG')
+        self.assertTrue('binaries' in max.record.__dict__)
+
+        # listing attribute names does not load binary values
+        max.attrs['signature'] = b'\x00'
+        session.flush()
+        session.expunge_all()
+        max = users['max']
+        self.assertEqual(
+            sorted(max.attrs.inspected_attrs)[-3:],
+            ['mail', 'portrait', 'signature']
+        )
+        self.assertEqual(max.attrs['portrait'], b'\x89PNG')
+        binaries = max.record.binaries
+        self.assertTrue('value' in binaries['portrait'].__dict__)
+        self.assertFalse('value' in binaries['signature'].__dict__)
+        max.attrs['signature'] = UNSET
+
+        max.attrs['portrait'] = b'\x89PNG2'
+        session.flush()
+        self.assertEqual(
+            session.query(SQLPrincipalBinary.value).scalar(),
+            b'\x89PNG2'
+        )
+
+        # unset binary attributes get removed
+        max.attrs['portrait'] = UNSET
+        session.flush()
+        self.assertEqual(session.query(SQLPrincipalBinary).count(), 0)
+        self.assertEqual(max.attrs['portrait'], None)
+
+        # legacy base64 encoded values in ``data`` are decoded once per record
+        max.record.data['portrait'] = base64.b64encode(b'\x89PNG').decode()
+        flag_modified(max.record, 'data')
+        with patch('cone.sql.ugm.base64.b64decode') as b64decode:
+            b64decode.return_value = b'\x89PNG'
+            self.assertEqual(max.attrs['portrait'], b'\x89PNG')
+            self.assertEqual(max.attrs['portrait'], b'\x89PNG')
+            self.assertEqual(b64decode.call_count, 1)
+        res = users.search(criteria=dict(id='max'), attrlist=['portrait'])
+        self.assertEqual(res, [('max', {'portrait': b'\x89PNG'})])
+
+        # setting binary attribute migrates legacy value
+        max.attrs['portrait'] = b'\x89PNG'
+        session.flush()
+        self.assertEqual(max.record.data, {'mail': 'max@example.com'})
+        self.assertEqual(session.query(SQLPrincipalBinary).count(), 1)
+        inspected_attrs = max.attrs.inspected_attrs
+        self.assertEqual(inspected_attrs.count('portrait'), 1)
+        self.assertFalse('binaries' in inspected_attrs)
+
+        # bulk created principals
+        users.create_many([('moritz', {'portrait': b'\x89PNG'})])
+        self.assertEqual(users['moritz'].attrs['portrait'], b'\x89PNG')
+
+        # binary attributes are deleted with principal
+        del users['max']
+        del users['moritz']
+        session.flush()
+        self.assertEqual(session.query(SQLPrincipalBinary).count(), 0)
+
+        session.commit()
+
+    @testing.transactional
+    def test_id_for_login(self):
+        self.layer.new_request()
+
+        ugm = Ugm(
+            name='sql_ugm',
+            parent=None,
+            user_attrs=['mail'],
+            group_attrs=[],
+            binary_attrs=[],
+            log_auth=False,
+            user_expires_attr=None
+        )
+        users = ugm.users
+        session = ugm.session
+
+        users.create('max', mail='max@example.com', login='mail')
+        users.create('moritz', mail='moritz@example.com')
+        session.flush()
+
+        # login values get normalized on insert
+        self.assertEqual(
+            [(r.user_guid, r.login) for r in session.query(SQLUserLogin)],
+            [(users['max'].record.guid, 'max@example.com')]
+        )
+        self.assertEqual(users.id_for_login('max@example.com'), 'max')
+        # fallback if no login found
+        self.assertEqual(
+            users.id_for_login('moritz@example.com'),
+            'moritz@example.com'
+        )
+
+        # login values get updated on record update
+        users['moritz'].attrs['login'] = 'mail'
+        users['max'].attrs['mail'] = 'max@example.org'
+        session.flush()
+        self.assertEqual(users.id_for_login('moritz@example.com'), 'moritz')
+        self.assertEqual(users.id_for_login('max@example.org'), 'max')
+        self.assertEqual(
+            users.id_for_login('max@example.com'),
+            'max@example.com'
+        )
+
+        # logins of users without ``user_login`` record are searched in
+        # JSON data if legacy login lookup is enabled, e.g. if
+        # ``rebuild_user_logins`` was not run yet
+        session.query(SQLUserLogin).delete()
+        self.assertEqual(
+            users.id_for_login('moritz@example.com'),
+            'moritz@example.com'
+        )
+        ugm.legacy_login_lookup = True
+        self.assertEqual(users.id_for_login('moritz@example.com'), 'moritz')
+        self.assertEqual(users.id_for_login('max@example.org'), 'max')
+        self.assertEqual(
+            users.id_for_login('unknown@example.com'),
+            'unknown@example.com'
+        )
+        ugm.legacy_login_lookup = False
+        rebuild_user_logins(session)
+
+        # login cache
+        login_cache.size = 10
+        try:
+            # lookups are not cached while logins changes are uncommitted
+            self.assertEqual(users.id_for_login('max@example.org'), 'max')
+            self.assertEqual(login_cache.data, {})
+            session.commit()
+            self.assertEqual(users.id_for_login('max@example.org'), 'max')
+            self.assertEqual(login_cache.data, {'max@example.org': 'max'})
+
+            # cache gets cleared after login changes were committed
+            users['max'].attrs['mail'] = 'max@example.net'
+            session.flush()
+            self.assertEqual(login_cache.data, {'max@example.org': 'max'})
+            self.assertEqual(users.id_for_login('max@example.net'), 'max')
+            session.commit()
+            self.assertEqual(login_cache.data, {})
+            self.assertEqual(users.id_for_login('max@example.net'), 'max')
+            self.assertEqual(login_cache.data, {'max@example.net': 'max'})
+
+            # rolled back login changes keep cache
+            del users['max']
+            session.flush()
+            self.assertEqual(
+                users.id_for_login('max@example.net'),
+                'max@example.net'
+            )
+            session.rollback()
+            self.assertEqual(login_cache.data, {'max@example.net': 'max'})
+            self.assertFalse(login_changes_key in session.info)
+
+            # cache gets cleared after user deletion was committed
+            del users['max']
+            session.commit()
+            self.assertEqual(login_cache.data, {})
+            self.assertEqual(session.query(SQLUserLogin).count(), 1)
+            self.assertEqual(
+                users.id_for_login('max@example.net'),
+                'max@example.net'
+            )
+        finally:
+            login_cache.size = 0
+            login_cache.clear()
+
+        session.commit()
+
+    @testing.transactional
+    def test_import_principals(self):
+        self.layer.new_request()
+
+        ugm = Ugm(
+            name='sql_ugm',
+            parent=None,
+            user_attrs=['mail', 'portrait'],
+            group_attrs=['title'],
+            binary_attrs=['portrait'],
+            log_auth=False,
+            user_expires_attr=None
+        )
+        users = ugm.users
+        groups = ugm.groups
+        users.create('existing')
+
+        ugm.import_principals(
+            users=[
+                ('user_{}'.format(i), {
+                    'mail': 'user_{}@example.com'.format(i),
+                    'login': 'mail'
+                }) for i in range(5)
+            ] + [('portrait', {'portrait': b'\x89PNG'})],
+            groups=[('group_1', {'title': 'Group 1'}), ('group_2', {})],
+            memberships=[
+                ('group_1', 'user_0'),
+                ('group_1', 'user_1'),
+                ('group_1', 'user_1'),
+                ('group_2', 'existing'),
+            ],
+            batch_size=2
+        )
+
+        self.assertEqual(len(users), 7)
+        self.assertEqual(sorted(groups.keys()), ['group_1', 'group_2'])
+
+        user = users['user_3']
+        self.assertEqual(user.attrs['mail'], 'user_3@example.com')
+        self.assertEqual(user.record.login, 'mail')
+        self.assertEqual(user.record.principal_roles, [])
+        self.assertEqual(users.id_for_login('user_3@example.com'), 'user_3')
+        self.assertEqual(users['portrait'].attrs['portrait'], b'\x89PNG')
+
+        self.assertEqual(groups['group_1'].attrs['title'], 'Group 1')
+        self.assertEqual(
+            sorted(groups['group_1'].member_ids),
+            ['user_0', 'user_1']
+        )
+        self.assertEqual(groups['group_2'].member_ids, ['existing'])
+        self.assertEqual(users['existing'].group_ids, ['group_2'])
+
+        # memberships must refer to existing principals
+        with self.assertRaises(KeyError):
+            ugm.import_principals(memberships=[('group_1', 'inexistent')])
+
+        ugm.session.commit()
+
+    @testing.transactional
+    def test_bulk_members(self):
+        self.layer.new_request()
+
+        ugm = Ugm(
+            name='sql_ugm',
+            parent=None,
+            user_attrs=[],
+            group_attrs=[],
+            binary_attrs=[],
+            log_auth=False,
+            user_expires_attr=None
+        )
+        users = ugm.users
+        groups = ugm.groups
+        for id in ['max', 'moritz', 'lempel', 'bolte']:
+            users.create(id)
+        group = groups.create('group')
+
+        # load collections to check whether they get expired properly
+        self.assertEqual(group.member_ids, [])
+        user = users['max']
+        self.assertEqual(user.group_ids, [])
+
+        group.add_members(['max', 'moritz'])
+        self.assertEqual(sorted(group.member_ids), ['max', 'moritz'])
+        self.assertEqual(user.group_ids, ['group'])
+
+        # adding existing members is tolerated
+        group.add_members(['max', 'lempel'])
+        self.assertEqual(
+            sorted(group.member_ids),
+            ['lempel', 'max', 'moritz']
+        )
+
+        group.remove_members(['max', 'bolte'])
+        self.assertEqual(sorted(group.member_ids), ['lempel', 'moritz'])
+        self.assertEqual(user.group_ids, [])
+
+        group.set_members(['moritz', 'bolte'])
+        self.assertEqual(sorted(group.member_ids), ['bolte', 'moritz'])
+        self.assertEqual(
+            ugm.session.query(SQLGroupAssignment).count(),
+            2
+        )
+
+        # inexistent users raise KeyError
+        with self.assertRaises(KeyError):
+            group.add_members(['inexistent'])
+        with self.assertRaises(KeyError):
+            group.remove_members(['inexistent'])
+        with self.assertRaises(KeyError):
+            group.set_members(['inexistent'])
+        self.assertEqual(sorted(group.member_ids), ['bolte', 'moritz'])
+
+        # changes survive commit
+        ugm.session.commit()
+        self.assertEqual(
+            sorted(groups['group'].member_ids),
+            ['bolte', 'moritz']
+        )
+
+    @testing.transactional
+    def test_ids_for_role(self):
+        self.layer.new_request()
+
+        ugm = Ugm(
+            name='sql_ugm',
+            parent=None,
+            user_attrs=[],
+            group_attrs=[],
+            binary_attrs=[],
+            log_auth=False,
+            user_expires_attr=None
+        )
+        users = ugm.users
+        groups = ugm.groups
+        users.create('max').add_role('editor')
+        users.create('moritz').add_role('editors')
+        users['moritz'].add_role('manager')
+        groups.create('group').add_role('editor')
+
+        self.assertEqual(users.ids_for_role('editor'), ['max'])
+        self.assertEqual(users.ids_for_role('manager'), ['moritz'])
+        self.assertEqual(users.ids_for_role('inexistent'), [])
+        self.assertEqual(groups.ids_for_role('editor'), ['group'])
+
+        ugm.session.commit()
+
+    @testing.transactional
+    def test_data_change_detection(self):
+        self.layer.new_request()
+
+        ugm = Ugm(
+            name='sql_ugm',
+            parent=None,
+            user_attrs=['mail'],
+            group_attrs=[],
+            binary_attrs=[],
+            log_auth=False,
+            user_expires_attr=None
+        )
+        user = ugm.users.create('max', mail='max@example.com')
+        session = ugm.session
+        session.commit()
+
+        # unchanged values do not modify record
+        user.attrs['mail'] = 'max@example.com'
+        self.assertFalse(session.is_modified(user.record))
+        self.assertFalse(has_changes(session))
+        with testing.QueryCounter(session.bind) as counter:
+            user()
+        self.assertEqual(counter.count, 0)
+
+        user.attrs['mail'] = 'max@example.org'
+        self.assertTrue(session.is_modified(user.record))
+        user()
+        self.assertEqual(ugm.users['max'].attrs['mail'], 'max@example.org')
+
+        # new keys modify record, even if value is empty
+        user.attrs['phone'] = None
+        self.assertTrue(session.is_modified(user.record))
+        user()
+        self.assertEqual(user.record.data, {
+            'mail': 'max@example.org',
+            'phone': None
+        })
+
+        # values changed in place are written when assigned again
+        user.attrs['tags'] = ['a']
+        user()
+        tags = user.attrs['tags']
+        tags.append('b')
+        user.attrs['tags'] = tags
+        self.assertTrue(session.is_modified(user.record))
+        user()
+        session.expire_all()
+        self.assertEqual(user.attrs['tags'], ['a', 'b'])
+
+        # on PostgreSQL single keys get updated with ``jsonb_set``
+        statement = jsonb_set_statement(user.record, 'mail', 'max@example.com')
+        compiled = statement.compile(dialect=postgresql.dialect())
+        self.assertEqual(str(compiled), (
+            'UPDATE principal SET data=jsonb_set('
+            'coalesce(principal.data, CAST(%(param_1)s::JSONB AS JSONB)), '
+            'CAST(%(param_2)s::TEXT[] AS TEXT[]), '
+            'CAST(%(param_3)s::JSONB AS JSONB)) '
+            'WHERE principal.guid = %(guid_1)s::UUID'
+        ))
+        self.assertEqual(compiled.params, {
+            'param_1': {},
+            'param_2': ['mail'],
+            'param_3': 'max@example.com',
+            'guid_1': user.record.guid
+        })
+
+        # ``jsonb_set`` is used for persistent records on PostgreSQL
+        def set_on_postgresql(name, value):
+            # load expired record before session gets patched
+            session.refresh(user.record)
+            bind = Mock()
+            bind.dialect.name = 'postgresql'
+            with patch.object(session, 'get_bind', return_value=bind), \
+                    patch.object(session, 'execute') as execute:
+                user.attrs[name] = value
+            return [call.args[0] for call in execute.call_args_list]
+
+        statements = set_on_postgresql('phone', '123')
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(
+            statements[0].compile(dialect=postgresql.dialect()).params,
+            {
+                'param_1': {},
+                'param_2': ['phone'],
+                'param_3': '123',
+                'guid_1': user.record.guid
+            }
+        )
+        self.assertFalse(session.is_modified(user.record))
+
+        # further keys of the record are written with the whole document
+        # on flush
+        with patch.object(session, 'execute') as execute:
+            user.attrs['fax'] = '456'
+        self.assertEqual(execute.call_count, 0)
+        self.assertTrue(session.is_modified(user.record))
+        user()
+
+        # pending changes of the document are written with it as well
+        user.attrs['fax'] = '789'
+        bind = Mock()
+        bind.dialect.name = 'postgresql'
+        with patch.object(session, 'get_bind', return_value=bind), \
+                patch.object(session, 'execute') as execute:
+            user.attrs['phone'] = '456'
+        self.assertEqual(execute.call_count, 0)
+        self.assertTrue(session.is_modified(user.record))
+        user()
+        self.assertEqual(user.record.data['fax'], '789')
+
+        # login values are written via the ORM to maintain ``user_login``
+        user.attrs['login'] = 'mail'
+        user()
+        self.assertEqual(ugm.users.id_for_login('max@example.org'), 'max')
+        login_cache.size = 10
+        try:
+            self.assertEqual(ugm.users.id_for_login('max@example.org'), 'max')
+            self.assertEqual(set_on_postgresql('mail', 'max@example.net'), [])
+            self.assertTrue(session.is_modified(user.record))
+            user()
+            self.assertEqual(login_cache.data, {})
+            self.assertEqual(
+                ugm.users.id_for_login('max@example.net'),
+                'max'
+            )
+            self.assertEqual(
+                session.query(SQLUserLogin.login).scalar(),
+                'max@example.net'
+            )
+        finally:
+            login_cache.size = 0
+            login_cache.clear()
+
+    @testing.transactional
+    def test_attr_name_memoization(self):
+        self.layer.new_request()
+
+        ugm = Ugm(
+            name='sql_ugm',
+            parent=None,
+            user_attrs=['mail', 'portrait'],
+            group_attrs=['title'],
+            binary_attrs=['portrait'],
+            log_auth=False,
+            user_expires_attr=None
+        )
+
+        # schema attributes are computed once per record class
+        names, name_set = schema_attrs_for(SQLUser)
+        self.assertIs(schema_attrs_for(SQLUser)[1], name_set)
+        self.assertEqual(sorted(names), sorted(name_set))
+        self.assertEqual(sorted(name_set), [
+            'created', 'first_login', 'id', 'last_login', 'login'
+        ])
+        self.assertEqual(sorted(schema_attrs_for(SQLGroup)[1]), [
+            'created', 'id'
+        ])
+
+        # attribute sets of UGM config are memoized until reassigned
+        binary_attrs = ugm.attr_set('binary_attrs')
+        self.assertEqual(binary_attrs, frozenset(['portrait']))
+        self.assertIs(ugm.attr_set('binary_attrs'), binary_attrs)
+        ugm.binary_attrs = []
+        self.assertEqual(ugm.attr_set('binary_attrs'), frozenset())
+        ugm.binary_attrs = ['portrait']
+
+        user = ugm.users.create('max', mail='max@example.com')
+        group = ugm.groups.create('group', title='Group')
+        self.assertIs(user.attrs.binary_attrs, ugm.attr_set('binary_attrs'))
+        self.assertEqual(user.attrs.schema_attrs, list(names))
+        self.assertTrue('mail' in user.attrs)
+        self.assertFalse('title' in user.attrs)
+        self.assertTrue('title' in group.attrs)
+
+        # schema attributes are set on record, others in ``data``
+        user.attrs['login'] = 'mail'
+        self.assertEqual(user.record.login, 'mail')
+        self.assertFalse('login' in user.record.data)
+
+        ugm.session.commit()
+
+    @testing.transactional
+    def test_iter_ids(self):
+        self.layer.new_request()
+
+        ugm = Ugm(
+            name='sql_ugm',
+            parent=None,
+            user_attrs=['mail'],
+            group_attrs=['title'],
+            binary_attrs=[],
+            log_auth=False,
+            user_expires_attr=None
+        )
+        for i in range(3):
+            ugm.users.create('user_{}'.format(i), mail='user@example.com')
+            ugm.groups.create('group_{}'.format(i), title='Group')
+        ugm()
+        session = ugm.session
+
+        # iterating users and groups only selects ids from subclass tables
+        with testing.QueryCounter(session.bind) as counter:
+            self.assertEqual(sorted(iter(ugm.users)), [
+                'user_0', 'user_1', 'user_2'
+            ])
+            self.assertEqual(sorted(iter(ugm.groups)), [
+                'group_0', 'group_1', 'group_2'
+            ])
+        self.assertEqual(counter.count, 2)
+        self.assertFalse(any([
+            'principal' in statement for statement in counter.statements
+        ]))
+
+    @testing.transactional
+    def test_create_without_flush(self):
+        self.layer.new_request()
+
+        ugm = Ugm(
+            name='sql_ugm',
+            parent=None,
+            user_attrs=['mail'],
+            group_attrs=['title'],
+            binary_attrs=[],
+            log_auth=False,
+            user_expires_attr=None
+        )
+        users = ugm.users
+        groups = ugm.groups
+        session = ugm.session
+
+        # creating principals does not touch the database
+        with testing.QueryCounter(session.bind) as counter:
+            created = [
+                users.create(
+                    'user_{}'.format(i),
+                    mail='user_{}@example.com'.format(i)
+                ) for i in range(5)
+            ]
+            group = groups.create('group', title='Group')
+        self.assertEqual(counter.count, 0)
+
+        # created nodes are usable before flush
+        user = created[0]
+        self.assertIsInstance(user, User)
+        self.assertEqual(user.id, 'user_0')
+        self.assertEqual(user.attrs['mail'], 'user_0@example.com')
+        self.assertIsNotNone(user.record.guid)
+        user.add_role('editor')
+        self.assertEqual(user.roles, ['editor'])
+        self.assertIsInstance(group, Group)
+        self.assertEqual(group.attrs['title'], 'Group')
+
+        # inserts get batched per table on flush
+        with testing.QueryCounter(session.bind) as counter:
+            session.flush()
+        self.assertEqual(counter.count, 3)
+
+        self.assertEqual(len(users), 5)
+        self.assertEqual(users['user_0'].roles, ['editor'])
+        self.assertEqual(groups.keys(), ['group'])
+        session.commit()
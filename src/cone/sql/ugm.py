@@ -1,9 +1,11 @@
 from cone.sql import SQLBase as Base
-from cone.sql import use_tm
+from cone.sql import persist_session
+from cone.sql import sql_session_setup
 from cone.sql.model import GUID
 from cone.sql.model import SQLRowNodeAttributes
 from cone.sql.model import SQLSession
 from cone.sql.model import UNICODE_TYPE
+from cone.sql.model import new_guid
 from datetime import datetime
 from node.behaviors import Attributes
 from node.behaviors import DefaultInit
@@ -24,13 +26,27 @@ from plumber import plumbing
 from sqlalchemy import Column
 from sqlalchemy import DateTime
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import Integer
+from sqlalchemy import LargeBinary
 from sqlalchemy import String
+from sqlalchemy import Text
 from sqlalchemy import and_
+from sqlalchemy import cast
+from sqlalchemy import delete
+from sqlalchemy import event
+from sqlalchemy import exists
+from sqlalchemy import func
+from sqlalchemy import insert
 from sqlalchemy import inspect
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.dialects.sqlite.base import SQLiteTypeCompiler
 from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.orm import attribute_keyed_dict
+from sqlalchemy.orm import deferred
+from sqlalchemy.orm import object_session
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm.attributes import flag_modified
 from sqlalchemy.orm.exc import NoResultFound
@@ -39,7 +55,6 @@ import hashlib
 import itertools
 import os
 import time
-import uuid
 
 
 # HACK: Force sqlite to alias JSONB as JSON. This allows to use JSONB for the
@@ -54,17 +69,30 @@ SQLiteTypeCompiler.visit_JSONB = SQLiteTypeCompiler.visit_JSON
 
 class SQLPrincipal(Base):
     __tablename__ = 'principal'
+    __table_args__ = (
+        # GIN index supporting role containment queries on PostgreSQL
+        Index(
+            'ix_principal_principal_roles',
+            'principal_roles',
+            postgresql_using='gin'
+        ).ddl_if(dialect='postgresql'),
+    )
     discriminator = Column(String)
     __mapper_args__ = {'polymorphic_on': discriminator}
     guid = Column(
         GUID,
-        default=lambda: str(uuid.uuid4()),
+        default=new_guid,
         index=True,
         primary_key=True
     )
     data = Column(JSONB)
     principal_roles = Column(JSONB, default=[])
     created = Column(DateTime, default=datetime.now)
+    binaries = relationship(
+        'SQLPrincipalBinary',
+        collection_class=attribute_keyed_dict('name'),
+        cascade='all, delete-orphan'
+    )
 
     def get_attribute(self, key):
         try:
@@ -73,6 +101,24 @@ class SQLPrincipal(Base):
             return self.data.get(key)
 
 
+class SQLPrincipalBinary(Base):
+    """Binary principal attributes.
+
+    Binary attributes like portraits are stored as raw bytes in a separate
+    table instead of base64 encoded in ``SQLPrincipal.data``. Values are
+    only loaded when accessed, one at a time.
+    """
+    __tablename__ = 'principal_binary'
+    principal_guid = Column(
+        GUID,
+        ForeignKey('principal.guid', deferrable=True, ondelete='CASCADE'),
+        primary_key=True
+    )
+    name = Column(String, primary_key=True)
+    # deferred, loading the names of binary attributes must not load values
+    value = deferred(Column(LargeBinary))
+
+
 class SQLGroup(SQLPrincipal):
     __tablename__ = 'group'
     __mapper_args__ = {'polymorphic_identity': 'sqlgroup'}
@@ -137,6 +183,204 @@ class SQLUser(SQLPrincipal):
     )
 
 
+class SQLUserLogin(Base):
+    """Normalized login lookup for users.
+
+    ``SQLUser.login`` contains the name of the attribute in ``data`` which
+    is used as login name. Querying this dynamic JSON key cannot use an
+    index, thus the login value gets denormalized into this table on user
+    insert and update.
+    """
+    __tablename__ = 'user_login'
+    user_guid = Column(
+        GUID,
+        ForeignKey('user.guid', deferrable=True, ondelete='CASCADE'),
+        primary_key=True
+    )
+    login = Column(String, index=True, nullable=False)
+
+
+def login_value(login, data):
+    """Return the login value for given login attribute name and user data
+    or None.
+    """
+    if not login or not data:
+        return None
+    value = data.get(login)
+    return value if isinstance(value, UNICODE_TYPE) else None
+
+
+class LoginCache(object):
+    """Bounded in-process login to user id cache.
+
+    Disabled if ``size`` is 0. The cache is cleared whenever a login changes
+    in this process. Logins changed by other processes are not recognized,
+    thus the cache is opt-in.
+    """
+
+    def __init__(self, size=0):
+        self.size = size
+        self.data = dict()
+
+    def get(self, login):
+        return self.data.get(login)
+
+    def set(self, login, id):
+        if not self.size:
+            return
+        if len(self.data) >= self.size:
+            self.data.clear()
+        self.data[login] = id
+
+    def clear(self):
+        self.data.clear()
+
+
+# Global login cache singleton.
+login_cache = LoginCache()
+
+# session info key flagging uncommitted login changes
+login_changes_key = 'cone.sql.ugm.login_changes'
+
+
+def logins_changed(session):
+    """Flag uncommitted login changes in session.
+
+    The login cache gets cleared after the session was committed. Lookups
+    are not cached while the session contains uncommitted login changes.
+    """
+    session.info[login_changes_key] = True
+
+
+def clear_login_cache(session):
+    if session.info.pop(login_changes_key, False):
+        login_cache.clear()
+
+
+def discard_login_changes(session, previous_transaction):
+    # savepoint rollbacks keep login changes of the enclosing transaction
+    if previous_transaction.parent is None:
+        session.info.pop(login_changes_key, None)
+
+
+@sql_session_setup
+def login_cache_session_setup(session):
+    event.listen(session, 'after_commit', clear_login_cache)
+    event.listen(session, 'after_soft_rollback', discard_login_changes)
+
+
+# session info key of guids of principals with ``jsonb_set`` writes in the
+# current transaction
+jsonb_set_writes_key = 'cone.sql.ugm.jsonb_set_writes'
+
+# types of values which cannot be changed in place
+immutable_types = (str, int, float, bool, type(None))
+
+
+def reset_jsonb_set_writes(session, previous_transaction=None):
+    if previous_transaction is None or previous_transaction.parent is None:
+        session.info.pop(jsonb_set_writes_key, None)
+
+
+@sql_session_setup
+def jsonb_set_session_setup(session):
+    event.listen(session, 'after_commit', reset_jsonb_set_writes)
+    event.listen(session, 'after_soft_rollback', reset_jsonb_set_writes)
+
+
+@event.listens_for(SQLUser, 'after_insert')
+def insert_user_login(mapper, connection, target):
+    value = login_value(target.login, target.data)
+    if value is not None:
+        table = SQLUserLogin.__table__
+        connection.execute(table.insert().values(
+            user_guid=target.guid,
+            login=value
+        ))
+
+
+@event.listens_for(SQLUser, 'after_update')
+def update_user_login(mapper, connection, target):
+    state = inspect(target)
+    if not any([
+        state.attrs[name].history.has_changes()
+        for name in ['login', 'data', 'id']
+    ]):
+        return
+    table = SQLUserLogin.__table__
+    connection.execute(table.delete().where(table.c.user_guid == target.guid))
+    insert_user_login(mapper, connection, target)
+    logins_changed(object_session(target))
+
+
+@event.listens_for(SQLUser, 'before_delete')
+def delete_user_login(mapper, connection, target):
+    table = SQLUserLogin.__table__
+    connection.execute(table.delete().where(table.c.user_guid == target.guid))
+    logins_changed(object_session(target))
+
+
+def jsonb_set_statement(record, name, value):
+    """Return statement setting ``name`` in JSON ``data`` of given principal
+    record to ``value`` with PostgreSQL ``jsonb_set``.
+    """
+    table = SQLPrincipal.__table__
+    data = func.coalesce(table.c.data, cast({}, JSONB))
+    return table.update()\
+        .where(table.c.guid == record.guid)\
+        .values(data=func.jsonb_set(
+            data,
+            cast([name], ARRAY(Text)),
+            cast(value, JSONB)
+        ))
+
+
+def decode_legacy_binary(record, name):
+    """Return decoded legacy base64 encoded binary attribute value from
+    ``data`` of given record.
+
+    Decoded values are memoized on the record as long as the encoded value
+    is unchanged.
+    """
+    value = record.data.get(name) if record.data else None
+    if not value:
+        return value
+    memo = record.__dict__.setdefault('_decoded_binaries', dict())
+    encoded, decoded = memo.get(name, (None, None))
+    if encoded != value:
+        decoded = base64.b64decode(value)
+        memo[name] = (value, decoded)
+    return decoded
+
+
+# technical attributes of principal records, not exposed as node attributes
+tech_attrs = frozenset([
+    'group_assignments', 'discriminator', 'guid',
+    'data', 'principal_roles', 'password', 'binaries'
+])
+
+# schema attribute names by principal record class
+_schema_attrs = dict()
+
+
+def schema_attrs_for(record_class):
+    """Return ``(names, name_set)`` tuple of schema attribute names of given
+    principal record class without the technical attributes.
+
+    ``names`` is a tuple in mapper order, ``name_set`` a frozenset for
+    membership tests. Memoized per record class.
+    """
+    try:
+        return _schema_attrs[record_class]
+    except KeyError:
+        names = tuple([
+            name for name in inspect(record_class).attrs.keys()
+            if name not in tech_attrs
+        ])
+        _schema_attrs[record_class] = names, frozenset(names)
+        return _schema_attrs[record_class]
+
+
 ###############################################################################
 # Node classes
 ###############################################################################
@@ -153,19 +397,82 @@ class PrincipalAttributes(SQLRowNodeAttributes):
     def __setitem__(self, name, value):
         if value is UNSET:
             value = ''
-        if value and name in self.binary_attrs:
-            value = base64.b64encode(value).decode()
-        if name in self.schema_attrs:
+        if name in self.binary_attrs:
+            self._set_binary(name, value)
+        elif name in schema_attrs_for(self.record.__class__)[1]:
             setattr(self.record, name, value)
         else:
-            self.record.data[name] = value
-            flag_modified(self.record, 'data')
+            self._set_data(name, value)
 
     def __getitem__(self, name):
-        value = self.record.get_attribute(name)
-        if value and name in self.binary_attrs:
-            value = base64.b64decode(value)
-        return value
+        if name in self.binary_attrs:
+            return self._get_binary(name)
+        return self.record.get_attribute(name)
+
+    def _set_data(self, name, value):
+        record = self.record
+        data = record.data
+        # mutable values might have been changed in place, they are the same
+        # objects as contained in ``data``
+        if name in data and isinstance(value, immutable_types) \
+                and type(data[name]) is type(value) and data[name] == value:
+            return
+        data[name] = value
+        state = inspect(record)
+        session = state.session
+        if not session or not self._use_jsonb_set(state, name):
+            flag_modified(record, 'data')
+            return
+        session.info.setdefault(jsonb_set_writes_key, set()).add(record.guid)
+        session.execute(jsonb_set_statement(record, name, value))
+
+    def _use_jsonb_set(self, state, name):
+        # on PostgreSQL only the changed key of persistent records gets
+        # written instead of the whole JSON document. This is done for the
+        # first changed key of a record per transaction, further changes are
+        # written with one ``UPDATE`` of the whole document on flush. Login
+        # values of users are written via the ORM, which maintains
+        # ``user_login``
+        record = state.obj()
+        session = state.session
+        if not state.persistent:
+            return False
+        if session.get_bind().dialect.name != 'postgresql':
+            return False
+        if isinstance(record, SQLUser) and name == record.login:
+            return False
+        if state.attrs.data.history.has_changes():
+            return False
+        return record.guid not in session.info.get(jsonb_set_writes_key, ())
+
+    def _set_binary(self, name, value):
+        record = self.record
+        binaries = record.binaries
+        if value:
+            binary = binaries.get(name)
+            if binary is None:
+                binaries[name] = SQLPrincipalBinary(name=name, value=value)
+            else:
+                binary.value = value
+        else:
+            binaries.pop(name, None)
+        # drop legacy base64 encoded value from ``data``
+        if record.data and name in record.data:
+            del record.data[name]
+            flag_modified(record, 'data')
+
+    def _get_binary(self, name):
+        record = self.record
+        binary = record.binaries.get(name)
+        if binary is not None:
+            return binary.value
+        # fall back to legacy base64 encoded value in ``data``
+        return decode_legacy_binary(record, name)
+
+    def __contains__(self, name):
+        if self.configured_attrs:
+            return name in self.configured_attr_set
+        return name in self.inspected_attrs
 
     @property
     def _columns(self):
@@ -178,27 +485,27 @@ class PrincipalAttributes(SQLRowNodeAttributes):
     def schema_attrs(self):
         """Fields that are in the record schema without the technical fields.
         """
-        tech_attrs = [
-            'group_assignments', 'discriminator', 'guid',
-            'data', 'principal_roles', 'password'
-        ]
-        schema_attrs = [
-            f for f in
-            inspect(self.record.__class__).attrs.keys()
-            if f not in tech_attrs
-        ]
-        return schema_attrs
+        return list(schema_attrs_for(self.record.__class__)[0])
 
     @property
     def inspected_attrs(self):
         """Fields that are in the record schema + keys from record.data without
         the technical fields.
         """
-        return self.schema_attrs + list(self.record.data.keys())
+        record = self.record
+        binary_names = [
+            name for name in record.binaries
+            if name not in record.data
+        ]
+        return (
+            self.schema_attrs
+            + list(record.data.keys())
+            + binary_names
+        )
 
     @property
     def binary_attrs(self):
-        return self.ugm.binary_attrs
+        return self.ugm.attr_set('binary_attrs')
 
 
 class UserAttributes(PrincipalAttributes):
@@ -207,6 +514,10 @@ class UserAttributes(PrincipalAttributes):
     def configured_attrs(self):
         return self.ugm.user_attrs
 
+    @property
+    def configured_attr_set(self):
+        return self.ugm.attr_set('user_attrs')
+
 
 class GroupAttributeFactory(PrincipalAttributes):
 
@@ -214,6 +525,10 @@ class GroupAttributeFactory(PrincipalAttributes):
     def configured_attrs(self):
         return self.ugm.group_attrs
 
+    @property
+    def configured_attr_set(self):
+        return self.ugm.attr_set('group_attrs')
+
 
 class PrincipalBehavior(Behavior):
 
@@ -267,10 +582,7 @@ class PrincipalBehavior(Behavior):
 
     @default
     def __call__(self):
-        if use_tm():
-            self.session.flush()
-        else:
-            self.session.commit()
+        persist_session(self.session)
 
 
 class UserBehavior(PrincipalBehavior, BaseUser):
@@ -363,6 +675,80 @@ class GroupBehavior(PrincipalBehavior, BaseGroup):
         user = self.ugm.users[id]
         self.record.users.append(user.record)
 
+    @default
+    def add_members(self, ids, batch_size=1000):
+        """Add users with given ids to group.
+
+        Memberships are written with bulk inserts without loading related
+        collections. Raises ``KeyError`` if users not exist.
+        """
+        guids = set(self.ugm.users.guids_for(ids, batch_size).values())
+        self._add_member_guids(guids.difference(self._member_guids()))
+
+    @default
+    def remove_members(self, ids, batch_size=1000):
+        """Remove users with given ids from group.
+
+        Memberships are removed with bulk deletes without loading related
+        collections. Raises ``KeyError`` if users not exist.
+        """
+        guids = set(self.ugm.users.guids_for(ids, batch_size).values())
+        self._remove_member_guids(guids, batch_size)
+
+    @default
+    def set_members(self, ids, batch_size=1000):
+        """Set users with given ids as group members.
+
+        Only the difference to existing memberships gets written. Raises
+        ``KeyError`` if users not exist.
+        """
+        guids = set(self.ugm.users.guids_for(ids, batch_size).values())
+        existing = self._member_guids()
+        self._add_member_guids(guids.difference(existing))
+        self._remove_member_guids(existing.difference(guids), batch_size)
+
+    @default
+    def _member_guids(self):
+        record = self.record
+        if inspect(record).pending:
+            self.session.flush()
+        res = self.session.execute(
+            select(SQLGroupAssignment.users_guid)
+            .where(SQLGroupAssignment.groups_guid == record.guid)
+        )
+        return set(res.scalars())
+
+    @default
+    def _add_member_guids(self, guids):
+        if not guids:
+            return
+        groups_guid = self.record.guid
+        self.session.execute(insert(SQLGroupAssignment), [
+            dict(groups_guid=groups_guid, users_guid=guid) for guid in guids
+        ])
+        self._expire_memberships(guids)
+
+    @default
+    def _remove_member_guids(self, guids, batch_size):
+        if not guids:
+            return
+        for batch in batched(guids, batch_size):
+            self.session.execute(
+                delete(SQLGroupAssignment)
+                .where(SQLGroupAssignment.groups_guid == self.record.guid)
+                .where(SQLGroupAssignment.users_guid.in_(batch))
+            )
+        self._expire_memberships(guids)
+
+    @default
+    def _expire_memberships(self, guids):
+        # expire membership collections of group and loaded users
+        session = self.session
+        session.expire(self.record, ['group_assignments'])
+        for record in list(session.identity_map.values()):
+            if isinstance(record, SQLUser) and record.guid in guids:
+                session.expire(record, ['group_assignments'])
+
     @default
     def __getitem__(self, key):
         res = self.ugm.users[key]
@@ -403,6 +789,50 @@ class Group(object):
     pass
 
 
+def split_binary_attrs(attrs, binary_attrs):
+    """Remove binary values from given attributes dict in place and return
+    them as dict.
+
+    Empty binary values are dropped.
+    """
+    binaries = dict()
+    for name in binary_attrs:
+        value = attrs.pop(name, None)
+        if value:
+            binaries[name] = value
+    return binaries
+
+
+def binary_records(binaries):
+    """Return dict of ``SQLPrincipalBinary`` records for given binary values.
+    """
+    return {
+        name: SQLPrincipalBinary(name=name, value=value)
+        for name, value in binaries.items()
+    }
+
+
+def binary_rows(guid, binaries):
+    """Return ``SQLPrincipalBinary`` insert parameters for given principal
+    guid and binary values.
+    """
+    return [
+        dict(principal_guid=guid, name=name, value=value)
+        for name, value in binaries.items()
+    ]
+
+
+def batched(iterable, size):
+    """Yield lists of ``size`` items from given iterable.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
 class PrincipalsBehavior(Behavior):
 
     @default
@@ -462,54 +892,129 @@ class PrincipalsBehavior(Behavior):
         else:
             clause = None
 
-        basequery = self.ugm.users.session.query(cls)
-        if clause is not None:
-            query = basequery.filter(clause)
-        else:
-            query = basequery
-
-        binary_attrs = self.ugm.binary_attrs
-
-        def get_attribute(p, k):
-            value = p.get_attribute(k)
-            if value and k in binary_attrs:
-                value = base64.b64decode(value)
-            return value
+        session = self.ugm.users.session
+
+        def select(*entities):
+            query = session.query(*entities)
+            if clause is not None:
+                query = query.filter(clause)
+            return query
+
+        # only project requested values instead of loading whole records.
+        # fixed columns are selected directly, all other attributes are
+        # extracted from the JSON ``data`` field by the database.
+        columns = inspect(cls).column_attrs
+        binary_attrs = self.ugm.attr_set('binary_attrs')
+
+        def attr_selectors(key):
+            if key in binary_attrs:
+                # binary value and legacy base64 encoded value from ``data``
+                binary = SQLPrincipalBinary
+                value = session.query(binary.value)\
+                    .filter(binary.principal_guid == cls.guid)\
+                    .filter(binary.name == key)\
+                    .scalar_subquery()
+                return [value, cls.data[key]]
+            if key in columns:
+                return [getattr(cls, key)]
+            return [cls.data[key]]
+
+        def attr_values(keys, values):
+            values = iter(values)
+            attrs = dict()
+            for key in keys:
+                value = next(values)
+                if key in binary_attrs:
+                    legacy = next(values)
+                    if value is None and legacy:
+                        value = base64.b64decode(legacy)
+                attrs[key] = value
+            return attrs
 
         # XXX: should we be lazy here and yield?, would be nice for looong lists
         if attrlist is not None:
             if attrlist:
+                query = select(cls.id, *itertools.chain.from_iterable(
+                    attr_selectors(k) for k in attrlist
+                ))
                 res = [
-                    (p.id, {k: get_attribute(p, k) for k in attrlist})
-                    for p in query.all()
+                    (row[0], attr_values(attrlist, row[1:]))
+                    for row in query
                 ]
-            # empty attrlist, so we take all attributes
+            # empty attrlist, so we take all attributes except binary ones.
+            # binary attributes must be requested explicitly.
             else:
-                def merged_attrs(p):
-                    # merge fixed attributes and dynamic attributes from ``data``
-                    attrs = {k: get_attribute(p, k) for k in fixed_attrs if k != 'id'}
-                    attrs.update(**{k: get_attribute(p, k) for k in p.data})
-                    return attrs
-
-                res = [(p.id, merged_attrs(p)) for p in query.all()]
-            res
+                keys = [k for k in fixed_attrs if k != 'id']
+                query = select(
+                    cls.id,
+                    cls.data,
+                    *[getattr(cls, k) if k in columns else cls.data[k]
+                      for k in keys]
+                )
+                res = list()
+                for row in query:
+                    # merge fixed attributes and dynamic attributes from
+                    # ``data``
+                    attrs = dict(zip(keys, row[2:]))
+                    attrs.update(**{
+                        k: v for k, v in (row[1] or {}).items()
+                        if k not in binary_attrs
+                    })
+                    res.append((row[0], attrs))
         else:
-            res = [p.id for p in query.all()]
+            res = [row[0] for row in select(cls.id)]
 
         if exact_match and not res:
             raise ValueError('no entries found')
         return res
 
+    @default
+    def ids_for_role(self, role):
+        """Return ids of principals having given role assigned directly.
+        """
+        cls = self.record_class
+        session = self.session
+        if session.bind.dialect.name == 'postgresql':
+            # JSONB containment, uses GIN index on ``principal_roles``
+            clause = cls.principal_roles.contains([role])
+        else:
+            roles = func.json_each(cls.principal_roles).table_valued('value')
+            clause = select(roles.c.value)\
+                .where(roles.c.value == role)\
+                .exists()
+        return [row[0] for row in session.query(cls.id).filter(clause)]
+
     @default
     def create(self, _id, **kw):
         raise NotImplementedError()
 
+    @default
+    def create_many(self, principals, batch_size=1000):
+        raise NotImplementedError()
+
+    @default
+    def guids_for(self, ids, batch_size=1000):
+        """Return dict mapping given principal ids to principal guids.
+
+        Raises ``KeyError`` if principals not exist.
+        """
+        cls = self.record_class
+        table = cls.__table__
+        ids = set(ids)
+        guids = dict()
+        for batch in batched(ids, batch_size):
+            res = self.session.execute(
+                select(table.c.id, table.c.guid).where(table.c.id.in_(batch))
+            )
+            guids.update(res.all())
+        missing = ids.difference(guids)
+        if missing:
+            raise KeyError(sorted(missing)[0])
+        return guids
+
     @default
     def __call__(self):
-        if use_tm():
-            self.session.flush()
-        else:
-            self.session.commit()
+        persist_session(self.session)
 
 
 ENCODING = 'utf-8'
@@ -593,21 +1098,52 @@ class UsersBehavior(PrincipalsBehavior, BaseUsers):
 
     @default
     def id_for_login(self, login):
+        # bypass cache if logins changed in this session and not committed
+        use_cache = not self.session.info.get(login_changes_key)
+        id = login_cache.get(login) if use_cache else None
+        if id is not None:
+            return id
+        user = SQLUser.__table__
+        try:
+            id = self.session.execute(
+                select(user.c.id)
+                .join(SQLUserLogin, SQLUserLogin.user_guid == user.c.guid)
+                .where(SQLUserLogin.login == login)
+            ).scalar_one()
+        except NoResultFound:
+            id = None
+            if self.ugm.legacy_login_lookup:
+                id = self._legacy_id_for_login(login)
+            if id is None:
+                # if we dont find a login field, fall back assuming id is login
+                return login
+        if use_cache:
+            login_cache.set(login, id)
+        return id
+
+    @default
+    def _legacy_id_for_login(self, login):
+        """Search user id by login in JSON ``data`` of users.
+
+        Used if no ``user_login`` record exists and ``legacy_login_lookup``
+        is enabled on UGM, thus login names of users created before the
+        ``user_login`` table was introduced still resolve if
+        ``cone.sql.migration.rebuild_user_logins`` was not run yet.
+        """
+        # Searchterm has to be enclosed in doublequotes to work on JSON fields
+        searchterm = '"%s"' % login
+        field_name = SQLUser.login
+        if self.session.bind.dialect.name == 'sqlite':
+            # If the key to the json field is variable we need a special
+            # treatment for sqlite
+            field_name = ('$.' + field_name).cast(String)
+        ids = self.session.query(SQLUser.id)\
+            .filter(SQLUser.data[field_name].cast(String) == searchterm)\
+            .filter(~exists().where(SQLUserLogin.user_guid == SQLUser.guid))
         try:
-            # Searchterm has to be enclosed in doublequotes to work on JSON fields
-            searchterm = '"%s"' % login
-            field_name = SQLUser.login
-            if self.session.bind.dialect.name == 'sqlite':
-                # If the key to the json field is variable we need a special
-                # treatment for sqlite
-                field_name = ('$.' + field_name).cast(String)
-            res = self.session.query(SQLUser).filter(
-                SQLUser.data[field_name].cast(String) == searchterm
-            ).one()
-            return res.id
+            return ids.one().id
         except NoResultFound:
-            # if we dont find a login field, fall back assuming id is login
-            return login
+            return None
 
     @default
     def __getitem__(self, id, default=None):
@@ -627,8 +1163,9 @@ class UsersBehavior(PrincipalsBehavior, BaseUsers):
 
     @default
     def __iter__(self):
-        users = self.session.query(SQLUser)
-        return iter(map(lambda u: u.id, users))
+        # select from subclass table only, ``principal`` needs no join
+        ids = self.session.query(SQLUser.__table__.c.id)
+        return iter(map(lambda row: row.id, ids))
 
     @default
     def __setitem__(self, key, value):
@@ -638,13 +1175,50 @@ class UsersBehavior(PrincipalsBehavior, BaseUsers):
     @default
     def create(self, _id, **kw):
         login = kw.pop('login', None)
-        for name, value in kw.items():
-            if value and name in self.ugm.binary_attrs:
-                kw[name] = base64.b64encode(value).decode()
-        sqluser = SQLUser(id=_id, login=login, data=kw)
+        binaries = split_binary_attrs(kw, self.ugm.binary_attrs)
+        # record gets inserted on next flush, which allows SQLAlchemy to
+        # batch inserts of multiple created users
+        sqluser = SQLUser(
+            guid=new_guid(),
+            id=_id,
+            login=login,
+            data=kw,
+            principal_roles=[],
+            binaries=binary_records(binaries)
+        )
         self.session.add(sqluser)
-        self.session.flush()
-        return self[_id]
+        return User(parent=self, record=sqluser)
+
+    @default
+    def create_many(self, principals, batch_size=1000):
+        """Create users from iterable of ``(id, attrs)`` tuples.
+
+        Records are written with batched bulk inserts. No user nodes are
+        created.
+        """
+        binary_attrs = self.ugm.binary_attrs
+        session = self.session
+        for batch in batched(principals, batch_size):
+            users = list()
+            logins = list()
+            binaries = list()
+            for _id, kw in batch:
+                data = dict(kw)
+                login = data.pop('login', None)
+                guid = new_guid()
+                binaries += binary_rows(
+                    guid,
+                    split_binary_attrs(data, binary_attrs)
+                )
+                users.append(dict(guid=guid, id=_id, login=login, data=data))
+                value = login_value(login, data)
+                if value is not None:
+                    logins.append(dict(user_guid=guid, login=value))
+            session.execute(insert(SQLUser), users)
+            if logins:
+                session.execute(insert(SQLUserLogin), logins)
+            if binaries:
+                session.execute(insert(SQLPrincipalBinary), binaries)
 
     @default
     def get_hashed_pw(self, id):
@@ -671,6 +1245,7 @@ class UsersBehavior(PrincipalsBehavior, BaseUsers):
 
     @default
     def invalidate(self, key=None, *a, **kw):
+        login_cache.clear()
         self.parent.invalidate(key='users')
 
 
@@ -692,13 +1267,42 @@ class GroupsBehavior(PrincipalsBehavior, BaseGroups):
 
     @default
     def create(self, _id, **kw):
-        for name, value in kw.items():
-            if value and name in self.ugm.binary_attrs:
-                kw[name] = base64.b64encode(value).decode()
-        sqlgroup = SQLGroup(id=_id, data=kw)
+        binaries = split_binary_attrs(kw, self.ugm.binary_attrs)
+        # record gets inserted on next flush, which allows SQLAlchemy to
+        # batch inserts of multiple created groups
+        sqlgroup = SQLGroup(
+            guid=new_guid(),
+            id=_id,
+            data=kw,
+            principal_roles=[],
+            binaries=binary_records(binaries)
+        )
         self.session.add(sqlgroup)
-        self.session.flush()
-        return self[_id]
+        return Group(parent=self, record=sqlgroup)
+
+    @default
+    def create_many(self, principals, batch_size=1000):
+        """Create groups from iterable of ``(id, attrs)`` tuples.
+
+        Records are written with batched bulk inserts. No group nodes are
+        created.
+        """
+        binary_attrs = self.ugm.binary_attrs
+        session = self.session
+        for batch in batched(principals, batch_size):
+            groups = list()
+            binaries = list()
+            for _id, kw in batch:
+                data = dict(kw)
+                guid = new_guid()
+                binaries += binary_rows(
+                    guid,
+                    split_binary_attrs(data, binary_attrs)
+                )
+                groups.append(dict(guid=guid, id=_id, data=data))
+            session.execute(insert(SQLGroup), groups)
+            if binaries:
+                session.execute(insert(SQLPrincipalBinary), binaries)
 
     @default
     def __getitem__(self, id, default=None):
@@ -724,8 +1328,9 @@ class GroupsBehavior(PrincipalsBehavior, BaseGroups):
 
     @default
     def __iter__(self):
-        groups = self.session.query(SQLGroup)
-        return iter(map(lambda u: u.id, groups))
+        # select from subclass table only, ``principal`` needs no join
+        ids = self.session.query(SQLGroup.__table__.c.id)
+        return iter(map(lambda row: row.id, ids))
 
     @default
     def __setitem__(self, key, value):
@@ -757,6 +1362,7 @@ class UgmBehavior(BaseUgm):
     binary_attrs = default([])
     log_auth = default(False)
     user_expires_attr = default(None)
+    legacy_login_lookup = default(False)
 
     @override
     def __init__(
@@ -767,7 +1373,8 @@ class UgmBehavior(BaseUgm):
         group_attrs,
         binary_attrs,
         log_auth,
-        user_expires_attr
+        user_expires_attr,
+        legacy_login_lookup=False
     ):
         self.__name__ = name
         self.__parent__ = parent
@@ -778,13 +1385,60 @@ class UgmBehavior(BaseUgm):
         self.binary_attrs = binary_attrs
         self.log_auth = log_auth
         self.user_expires_attr = user_expires_attr
+        self.legacy_login_lookup = legacy_login_lookup
 
     @default
     def __call__(self):
-        if use_tm():
-            self.session.flush()
-        else:
-            self.session.commit()
+        persist_session(self.session)
+
+    @default
+    def attr_set(self, name):
+        """Return frozenset of attribute names configured on attribute with
+        given name, e.g. ``binary_attrs``.
+
+        Memoized until the configuration attribute gets reassigned.
+        """
+        value = getattr(self, name)
+        attr_sets = self.__dict__.setdefault('_attr_sets', dict())
+        cached = attr_sets.get(name)
+        if cached is None or cached[0] is not value:
+            cached = attr_sets[name] = (value, frozenset(value or ()))
+        return cached[1]
+
+    @default
+    def import_principals(
+        self,
+        users=(),
+        groups=(),
+        memberships=(),
+        batch_size=1000
+    ):
+        """Bulk import users, groups and group memberships.
+
+        ``users`` and ``groups`` are iterables of ``(id, attrs)`` tuples.
+        ``memberships`` is an iterable of ``(group_id, user_id)`` tuples,
+        referring to imported or already existing principals. Changes are
+        not committed.
+        """
+        self.users.create_many(users, batch_size=batch_size)
+        self.groups.create_many(groups, batch_size=batch_size)
+        memberships = set(memberships)
+        if not memberships:
+            return
+        group_guids = self.groups.guids_for(
+            [gid for gid, _ in memberships],
+            batch_size=batch_size
+        )
+        user_guids = self.users.guids_for(
+            [uid for _, uid in memberships],
+            batch_size=batch_size
+        )
+        session = self.session
+        for batch in batched(memberships, batch_size):
+            session.execute(insert(SQLGroupAssignment), [
+                dict(groups_guid=group_guids[gid], users_guid=user_guids[uid])
+                for gid, uid in batch
+            ])
 
     @default
     def add_role(self, role, principal):